@@ -1,7 +1,9 @@
 from opentrons import protocol_api
+import csv
 import json
 import os
 import math
+from time import monotonic, strftime
 
 # metadata
 metadata = {
@@ -15,30 +17,222 @@ NUM_SAMPLES = 96  # start with 8 samples, slowly increase to 48, then 94 (max is
 SAMPLE_VOL = 10
 PREPARE_MASTERMIX = False
 TIP_TRACK = False
+COLUMN_TIP = 0  # first unused column of the first 20µl tiprack (0-11)
+POOL = False  # the elution plate holds samples and pools, as in Station B
+POOL_SIZE = 2  # samples per pool, as in the Station A pooling protocol
+POOL_COLUMN = 8  # column index of the first pool (8 is column 9), None for right after the samples
+HEIGHT_TRACK = True  # aspirate from the mastermix and component tubes just below the meniscus
+MM_FLOW = 50  # mastermix aspirate flow rate (µl/s) with HEIGHT_TRACK, 15 at the bottom of the tube without it
+TUBE_DEAD_VOL = 20  # µl left in the bottom of each component tube (and of a mastermix tube filled by hand) that the pipette cannot aspirate
+CONDITIONING_VOL = 10  # extra mastermix aspirated on every strip fill trip and returned to the tube, not used with the p20_single_gen2
+SOURCE_PLATES = [('1', 'opentrons_96_aluminumblock_nest_wellplate_100ul')]  # elution plates (slot, labware), plate 1, 2... of MANIFEST
+MANIFEST = None  # CSV text of the transfers, one 'plate,source column,destination column' line per column (e.g. '1,9,1\n2,9,2'), None for the columns of NUM_SAMPLES or POOL on plate 1
+OUTPUT_PLATE = 96  # 96 or 384 well PCR plate, see PCR_PLATES. On 384 destination columns 13-48 are quadrants 2-4 and without MANIFEST each source plate fills its own quadrant
+STRIP_MAX_VOL = 190  # µl of mastermix per strip well, more mastermix goes to the next strip column
+CONTROLS = []  # (name, tube_block well, PCR plate well) pipetted in order after the samples with the p20_single_gen2, e.g. [('negative control', 'D2', 'H12'), ('positive control', 'D1', 'G12')] with NUM_SAMPLES = 94. The other samples of a column with a control are transferred one by one
+SINGLE_PIPETTE = 'p300_single_gen2'  # left mount pipette for the mastermix and the controls, 'p20_single_gen2' is needed by CONTROLS but fills the strips in 20µl trips
+
+# Tube geometry for the liquid height model: inner radius of the tube (mm)
+# and height of its conical bottom (mm), per tube block labware
+TUBE_GEOMETRY = {
+    'opentrons_24_aluminumblock_nest_2ml_snapcap': {'radius': 4.35, 'bottom': 6.0},
+    'opentrons_24_aluminumblock_nest_2ml_screwcap': {'radius': 4.2, 'bottom': 5.0},
+    'opentrons_24_aluminumblock_generic_2ml_screwcap': {'radius': 4.1, 'bottom': 5.0}
+}
+
+# PCR plate per OUTPUT_PLATE: labware on the temperature module and
+# reaction volumes per well (µl)
+PCR_PLATES = {
+    96: {'labware': 'opentrons_96_aluminumblock_nest_wellplate_100ul',
+         'mastermix': 15, 'sample': SAMPLE_VOL},
+    384: {'labware': 'biorad_384_wellplate_50ul', 'mastermix': 5, 'sample': 5}
+}
+
+
+def pool_layout(num_samples, pool_size, first_pool_col=8, rows=8, cols=12):
+    """
+    `pool_layout` describes a pooled sample plate, the same description is
+    used by the Station A pooling protocol and the POOL mode of Stations B and
+    C. The samples fill the plate column by column from A1 and are pooled in
+    order, pool_size at a time, into the wells from the top of first_pool_col.
+    When the samples do not divide evenly the last pool is smaller.
+    :param num_samples (int): Number of samples on the plate.
+    :param pool_size (int): Number of samples per pool (2, 4, 8...).
+    :param first_pool_col (int): Index of the first column of pools, None to
+                                 start the pools after the sample columns.
+    :param rows (int): Number of rows of the plate.
+    :param cols (int): Number of columns of the plate.
+    :return: The pools as (pool well index, sample well indices), and the
+             indices of the columns that hold samples or pools.
+    """
+    if pool_size < 2:
+        raise Exception('POOL_SIZE must be at least 2.')
+    num_cols = math.ceil(num_samples/rows)
+    if first_pool_col is None:
+        first_pool_col = num_cols
+    pools = [(first_pool_col*rows + n,
+              list(range(s, min(s + pool_size, num_samples))))
+             for n, s in enumerate(range(0, num_samples, pool_size))]
+    pool_cols = math.ceil(len(pools)/rows)
+    if num_cols > first_pool_col or first_pool_col + pool_cols > cols:
+        raise Exception(str(num_samples) + ' samples in pools of ' + \
+str(pool_size) + ' do not fit in the plate with the pools from column ' + \
+str(first_pool_col + 1) + '.')
+    return pools, list(range(num_cols)) + \
+        list(range(first_pool_col, first_pool_col + pool_cols))
+
+
+def read_manifest(text, num_plates, cols=12, dest_cols=12):
+    """
+    `read_manifest` reads and validates a CSV manifest of sample transfers,
+    one line per column: source plate, source column and destination column
+    of the PCR plate, all numbered from 1. Empty lines and a header line are
+    skipped.
+    :param text (str): The CSV text of the manifest.
+    :param num_plates (int): Number of source plates on the deck.
+    :param cols (int): Number of columns of the source plates.
+    :param dest_cols (int): Number of destination columns, 48 for the four
+                            quadrants of a 384 well plate.
+    :return: The transfers as (plate index, source column index, destination
+             column index).
+    """
+    transfers = []
+    for n, line in enumerate(csv.reader(text.strip().splitlines())):
+        if not line or (n == 0 and not line[0].strip().isdigit()):
+            continue
+        where = 'Manifest line ' + str(n+1) + ' (' + ','.join(line) + ')'
+        if len(line) != 3 or not all(v.strip().isdigit() for v in line):
+            raise Exception(where + ' must be plate,source column,destination \
+column.')
+        plate, source, dest = [int(v) - 1 for v in line]
+        if not 0 <= plate < num_plates:
+            raise Exception(where + ': there are ' + str(num_plates) + \
+' source plates in SOURCE_PLATES.')
+        if not 0 <= source < cols or not 0 <= dest < dest_cols:
+            raise Exception(where + ': source columns go from 1 to ' + \
+str(cols) + ' and destination columns from 1 to ' + str(dest_cols) + '.')
+        if any(t[:2] == (plate, source) for t in transfers):
+            raise Exception(where + ': the source column is already \
+transferred.')
+        if any(t[2] == dest for t in transfers):
+            raise Exception(where + ': the destination column is already \
+used.')
+        transfers.append((plate, source, dest))
+    if not transfers:
+        raise Exception('The manifest has no transfers.')
+    return transfers
 
 
 def run(ctx: protocol_api.ProtocolContext):
     global MM_TYPE
 
+    if OUTPUT_PLATE not in PCR_PLATES:
+        raise Exception('OUTPUT_PLATE must be 96 or 384.')
+    reaction = PCR_PLATES[OUTPUT_PLATE]
+    if SINGLE_PIPETTE == 'p20_single_gen2' and PREPARE_MASTERMIX:
+        raise Exception('PREPARE_MASTERMIX needs the p300_single_gen2.')
+    if SINGLE_PIPETTE == 'p300_single_gen2' and CONTROLS:
+        raise Exception('The controls are below the 20µl minimum of the \
+p300_single_gen2, use the p20_single_gen2 or set CONTROLS = [].')
+    # a 384 well plate takes four 96 well quadrants
+    quadrants = 4 if OUTPUT_PLATE == 384 else 1
     # check source (elution) labware type
-    source_plate = ctx.load_labware(
-        'opentrons_96_aluminumblock_nest_wellplate_100ul', '1',
-        'chilled elution plate on block from Station B')
+    source_plates = [
+        ctx.load_labware(labware, slot,
+                         'chilled elution plate on block from Station B')
+        for slot, labware in SOURCE_PLATES]
+    # transfers of the run as (source plate, source column, destination
+    # column), from the manifest or else the columns of plate 1. With POOL the
+    # pools are in the same columns of the elution plate as in Station B.
+    if MANIFEST:
+        if POOL:
+            raise Exception('POOL cannot be used with a MANIFEST, list the \
+pool columns in the manifest.')
+        transfers = read_manifest(MANIFEST, len(source_plates),
+                                  dest_cols=12*quadrants)
+        # the manifest describes columns, every reaction column is full
+        reaction_wells = [8*d + r for _, _, d in transfers for r in range(8)]
+    elif POOL:
+        pools, sample_cols = pool_layout(NUM_SAMPLES, POOL_SIZE, POOL_COLUMN)
+        transfers = [(0, c, c) for c in sample_cols]
+        reaction_wells = list(range(NUM_SAMPLES)) + [w for w, _ in pools]
+    else:
+        # the samples fill one source plate after the other, on a 384 well
+        # plate each one in its own quadrant
+        max_samples = 96*min(quadrants, len(source_plates))
+        if NUM_SAMPLES > max_samples:
+            raise Exception('Too many samples (' + str(NUM_SAMPLES) + ') for \
+a ' + str(OUTPUT_PLATE) + ' well plate from ' + str(len(source_plates)) + \
+' source plate(s), the maximum is ' + str(max_samples) + '.')
+        sample_cols = list(range(math.ceil(NUM_SAMPLES/8)))
+        transfers = [(c//12, c % 12, c) for c in sample_cols]
+        reaction_wells = list(range(NUM_SAMPLES))
+    num_cols = len(transfers)
+
+    # destination column of a PCR plate well name, see dest_wells
+    def dest_col(name):
+        if not (name[:1].isalpha() and name[1:].isdigit()):
+            return None
+        row, col = ord(name[0].upper()) - ord('A'), int(name[1:]) - 1
+        if OUTPUT_PLATE == 384:
+            return 24*(row % 2) + 12*(col % 2) + col//2
+        return col
+
+    # the multichannel would also fill the control wells of a destination
+    # column, the samples of those columns go one by one with the single
+    # channel pipette
+    control_cols = set(dest_col(well) for _, _, well in CONTROLS) & \
+        set(d for _, _, d in transfers)
+
+    # first tip of the run, COLUMN_TIP or where the last run with TIP_TRACK
+    # stopped
+    tip_start = {'tips20': COLUMN_TIP, 'tips300': 0}
+    folder_path = '/data/C'
+    tip_file_path = folder_path + '/tip_log.json'
+    if TIP_TRACK and not ctx.is_simulating() and os.path.isfile(tip_file_path):
+        with open(tip_file_path) as json_file:
+            tip_start.update(json.load(json_file))
+
+    # tip budget: one 20µl tip column for the mastermix and one per sample
+    # column, only the tipracks the run needs from the first tip on are
+    # loaded
+    tip_cols = 1 + num_cols - len(control_cols)
+    tip_slots = [slot for slot in ['2', '3', '6', '7', '10', '11']
+                 if slot not in [p[0] for p in SOURCE_PLATES]]
+    if tip_start['tips20'] >= 12*len(tip_slots):
+        ctx.comment('The tip log is past the last tiprack, the run starts \
+with new tipracks.')
+        tip_start['tips20'] = 0
+    if tip_start['tips300'] >= 96:
+        tip_start['tips300'] = 0
+    first = tip_start['tips20']
+    tip_slots = tip_slots[:max(1, min(len(tip_slots),
+                                      math.ceil((first + tip_cols)/12)))]
+    ctx.comment('The run uses ' + str(tip_cols) + ' columns of 20µl tips: load \
+tipracks on slot(s) ' + ', '.join(tip_slots) + ', the first tip is in column ' + \
+str(first % 12 + 1) + ' of slot ' + tip_slots[first//12] + '.')
+    left = 12*len(tip_slots) - first - tip_cols
+    if 0 < left < 12:
+        ctx.comment('The tiprack on slot ' + tip_slots[-1] + ' will keep ' + \
+str(left) + ' columns, use it as the first tiprack of the next run \
+with COLUMN_TIP = ' + str(12 - left) + '.')
     tips20 = [
         ctx.load_labware('opentrons_96_filtertiprack_20ul', slot)
-        for slot in ['2', '3']
+        for slot in tip_slots
     ]
-    tips300 = [ctx.load_labware('opentrons_96_filtertiprack_200ul', '9')]
+    tips300 = [ctx.load_labware(
+        'opentrons_96_filtertiprack_200ul' if SINGLE_PIPETTE == 'p300_single_gen2'
+        else 'opentrons_96_filtertiprack_20ul', '9')]
     tempdeck = ctx.load_module('Temperature Module Gen2', '4')
-    pcr_plate = tempdeck.load_labware(
-        'opentrons_96_aluminumblock_nest_wellplate_100ul', 'PCR plate')
+    #TEMPERATURE
+    # start cooling the PCR plate now, the run only waits for it before the
+    # samples are transferred
+    temp_ramp = {'celsius': 8, 'start': monotonic(), 'done': False}
+    tempdeck.start_set_temperature(temp_ramp['celsius'])
+    pcr_plate = tempdeck.load_labware(reaction['labware'], 'PCR plate')
     mm_strips = ctx.load_labware(
         'opentrons_96_aluminumblock_nest_wellplate_100ul', '5',
         'mastermix strips')
-    
-    #TEMPERATURE
-    tempdeck.set_temperature(8)
-
 
     tube_block = ctx.load_labware(
         'opentrons_24_aluminumblock_nest_2ml_snapcap', '8',
@@ -46,32 +240,60 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # pipette
     m20 = ctx.load_instrument('p20_multi_gen2', 'right', tip_racks=tips20)
-    p300 = ctx.load_instrument('p300_single_gen2', 'left', tip_racks=tips300)
+    p300 = ctx.load_instrument(SINGLE_PIPETTE, 'left', tip_racks=tips300)
 
     # setup up sample sources and destinations
-    num_cols = math.ceil(NUM_SAMPLES/8)
-    sources = source_plate.rows()[0][:num_cols]
-    sample_dests = pcr_plate.rows()[0][:num_cols]
+    sources = [source_plates[p].rows()[0][c] for p, c, d in transfers
+               if d not in control_cols]
+    # destination column d of quadrant d//12 starts on row A or B (d//24)
+    # and on the odd or even columns (d//12 % 2) of a 384 well plate
+    def dest_wells(d):
+        if OUTPUT_PLATE == 384:
+            return pcr_plate.columns()[2*(d % 12) + d//12 % 2][d//24::2]
+        return pcr_plate.columns()[d]
 
-    tip_log = {'count': {}}
-    folder_path = '/data/C'
-    tip_file_path = folder_path + '/tip_log.json'
-    if TIP_TRACK and not ctx.is_simulating():
-        if os.path.isfile(tip_file_path):
-            with open(tip_file_path) as json_file:
-                data = json.load(json_file)
-                if 'tips20' in data:
-                    tip_log['count'][m20] = data['tips20']
-                else:
-                    tip_log['count'][m20] = 0
-                if 'tips300' in data:
-                    tip_log['count'][p300] = data['tips300']
-                else:
-                    tip_log['count'][p300] = 0
+    sample_dests = [dest_wells(d)[0] for _, _, d in transfers]
+    multi_dests = [dest_wells(d)[0] for _, _, d in transfers
+                   if d not in control_cols]
+
+    # plate map of the run, the wells of the reactions of every destination
+    # column hold the source well of the same row
+    well_names = {}
+    for plate in [pcr_plate] + source_plates:
+        well_names.update({well: name
+                           for name, well in plate.wells_by_name().items()})
+    plate_map = {}
+    for p, c, d in transfers:
+        for r, (src, dest) in enumerate(zip(source_plates[p].columns()[c],
+                                            dest_wells(d))):
+            if d*8 + r in reaction_wells:
+                plate_map[dest] = 'plate ' + str(p+1) + ' ' + well_names[src]
+
+    # controls: a control in a column of the samples gets its mastermix from
+    # the strips with the samples, any other control from the mastermix tube
+    controls = []
+    mm_controls = []
+    for name, tube, well in CONTROLS:
+        if tube not in tube_block.wells_by_name() or \
+                well not in pcr_plate.wells_by_name():
+            raise Exception('The ' + name + ' (' + tube + ' to ' + well + ') \
+is not a well of the tube block and the PCR plate.')
+        dest = pcr_plate.wells_by_name()[well]
+        if dest in plate_map:
+            raise Exception('The ' + name + ' well ' + well + ' holds ' + \
+plate_map[dest] + ', lower NUM_SAMPLES or move the control.')
+        controls.append((tube_block.wells_by_name()[tube], dest))
+        plate_map[dest] = name + ' (tube ' + tube + ')'
+        column = [(d, r) for _, _, d in transfers
+                  for r, w in enumerate(dest_wells(d)) if w == dest]
+        if column:
+            reaction_wells.append(column[0][0]*8 + column[0][1])
         else:
-            tip_log['count'] = {m20: 0, p300: 0}
-    else:
-        tip_log['count'] = {m20: 0, p300: 0}
+            mm_controls.append(dest)
+    num_reactions = len(reaction_wells) + len(mm_controls)
+
+    tip_log = {'count': {m20: tip_start['tips20'],
+                         p300: tip_start['tips300']}}
 
     tip_log['tips'] = {
         m20: [tip for rack in tips20 for tip in rack.rows()[0]],
@@ -82,9 +304,36 @@ def run(ctx: protocol_api.ProtocolContext):
         for pip in [m20, p300]
     }
 
+    def await_temperature():
+        """
+        `await_temperature` waits for the temperature module to reach the
+        temperature started when it was loaded. The ramp time (an upper bound
+        when the block was already cold) and the time the run had to wait are
+        commented and appended to /data/C/temperature_log.json.
+        """
+        if temp_ramp['done']:
+            return
+        waited = monotonic()
+        tempdeck.await_temperature(temp_ramp['celsius'])
+        end = monotonic()
+        temp_ramp['done'] = True
+        ramp = (end - temp_ramp['start'])/60
+        wait = (end - waited)/60
+        ctx.comment('Temperature module at ' + str(temp_ramp['celsius']) + \
+'°C after ' + str(round(ramp, 1)) + ' minutes (waited ' + str(round(wait, 1)) + \
+' minutes).')
+        if not ctx.is_simulating():
+            if not os.path.isdir(folder_path):
+                os.mkdir(folder_path)
+            with open(folder_path + '/temperature_log.json', 'a') as temp_file:
+                temp_file.write(json.dumps({
+                    'time': strftime('%Y-%m-%d %H:%M:%S'),
+                    'celsius': temp_ramp['celsius'], 'ramp_minutes': ramp,
+                    'waited_minutes': wait}) + '\n')
+
     def pick_up(pip):
         nonlocal tip_log
-        if tip_log['count'][pip] == tip_log['max'][pip]:
+        if tip_log['count'][pip] >= tip_log['max'][pip]:
             ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
 resuming.')
             pip.reset_tipracks()
@@ -95,55 +344,88 @@ resuming.')
     """ mastermix component maps """
     mm_tube = tube_block.wells()[0]
     mm_dict = {
-        'volume': 15,
+        'volume': reaction['mastermix'],
         'components': {
-            tube: vol for tube, vol in zip(tube_block.columns()[1][:3],
-                                           [6.25, 1.25, 7.5])
+            tube: vol*reaction['mastermix']/15
+            for tube, vol in zip(tube_block.columns()[1][:3],
+                                 [6.25, 1.25, 7.5])
         }
     }
 
-    vol_overage = 1.01 if NUM_SAMPLES > 48 else 1.02  # decrease overage for small sample number
-    total_mm_vol = mm_dict['volume']*(NUM_SAMPLES+2)*vol_overage
-    # translate total mastermix volume to starting height
-    r = mm_tube.diameter/2
-    mm_height = total_mm_vol/(math.pi*(r**2)) - 5
+    vol_overage = 1.01 if num_reactions > 48 else 1.02  # decrease overage for small sample number
+    total_mm_vol = mm_dict['volume']*num_reactions*vol_overage
+    if total_mm_vol + TUBE_DEAD_VOL > mm_tube.max_volume:
+        raise Exception(str(round(total_mm_vol + TUBE_DEAD_VOL)) + 'µl of \
+mastermix do not fit in the mastermix tube (' + str(mm_tube.max_volume) + 'µl).')
+
+    # liquid in the mastermix and component tubes, the tubes are modelled as
+    # a cone at the bottom and a cylinder above it
+    geometry = TUBE_GEOMETRY.get(tube_block.load_name)
+    tube_vols = {mm_tube: 0 if PREPARE_MASTERMIX
+                 else total_mm_vol + TUBE_DEAD_VOL}
 
-    def h_track(vol):
-        nonlocal mm_height
-        dh = 1.1*vol/(math.pi*(r**2))  # compensate for 10% theoretical volume loss
-        mm_height = mm_height - dh if mm_height - dh > 2 else 2  # stop at 2mm above mm tube bottom
-        return mm_tube.bottom(mm_height)
+    def liquid_height(vol):
+        """
+        `liquid_height` translates a volume in a tube into the height (in mm)
+        of the meniscus above the bottom of the tube.
+        :param vol (float): The volume of liquid in the tube.
+        """
+        area = math.pi*geometry['radius']**2
+        bottom_vol = area*geometry['bottom']/3
+        if vol <= bottom_vol:
+            return geometry['bottom']*(max(vol, 0)/bottom_vol)**(1/3)
+        return geometry['bottom'] + (vol - bottom_vol)/area
+
+    def h_track(tube, vol, bottom=1):
+        """
+        `h_track` takes `vol` from a tube and returns where to aspirate it:
+        2mm below the meniscus left after the aspiration, never lower than
+        `bottom`.
+        :param tube (Well): The mastermix or component tube.
+        :param vol (float): The volume to aspirate.
+        :param bottom (float): Lowest height above the bottom of the tube.
+        """
+        tube_vols[tube] -= vol
+        if not HEIGHT_TRACK or not geometry:
+            return tube.bottom(bottom)
+        return tube.bottom(max(liquid_height(tube_vols[tube]) - 2, bottom))
 
     def mix_up_down(reps, vol, loc, pip):
         for _ in range(reps):
             pip.aspirate(vol, loc.bottom(5))
-            pip.dispense(vol, loc.bottom(loc._depth/2), 3)
+            pip.dispense(vol, loc.bottom((loc.top().point.z - loc.bottom().point.z)/2), 3)
             #pip.dispense(vol, loc.top(), 3)
             pip.aspirate(vol, loc.bottom(5))
             pip.dispense(vol, loc.top())
 
     if PREPARE_MASTERMIX:
-        vol_overage = 1.1 if NUM_SAMPLES > 48 else 1.04
+        vol_overage = 1.1 if num_reactions > 48 else 1.04
 
+        for tube, vol in mm_dict['components'].items():
+            tube_vols[tube] = vol*(num_reactions)*vol_overage + TUBE_DEAD_VOL
+            ctx.comment('Fill ' + tube.display_name + ' with ' + \
+str(round(tube_vols[tube])) + 'µl.')
         for i, (tube, vol) in enumerate(mm_dict['components'].items()):
-            comp_vol = vol*(NUM_SAMPLES)*vol_overage
+            comp_vol = vol*(num_reactions)*vol_overage
             pick_up(p300)
             num_trans = math.ceil(comp_vol/160)
             vol_per_trans = comp_vol/num_trans
             for _ in range(num_trans):
                 p300.air_gap(20)
-                p300.aspirate(vol_per_trans, tube.bottom(1.5), 0.4)
+                p300.aspirate(vol_per_trans, h_track(tube, vol_per_trans, 1.5),
+                              0.4)
                 ctx.delay(seconds=3)
                 p300.touch_tip(tube)
                 p300.air_gap(20)
                 p300.dispense(20, mm_tube.top())  # void air gap
                 p300.dispense(vol_per_trans, mm_tube.bottom(2))
+                tube_vols[mm_tube] += vol_per_trans
                 p300.dispense(20, mm_tube.top())  # void pre-loaded air gap
                 p300.blow_out(mm_tube.top())
                 p300.touch_tip(mm_tube)
             if i < len(mm_dict['components'].items()) - 1:  # only keep tip if last component and p300 in use
                 p300.drop_tip()
-        mm_total_vol = mm_dict['volume']*(NUM_SAMPLES)*vol_overage
+        mm_total_vol = mm_dict['volume']*(num_reactions)*vol_overage
         if not p300.hw_pipette['has_tip']:  # pickup tip with P300 if necessary for mixing
             pick_up(p300)
         mix_vol = mm_total_vol / 2 if mm_total_vol / 2 <= 200 else 200  # mix volume is 1/2 MM total, maxing at 200µl
@@ -158,34 +440,129 @@ resuming.')
         p300.touch_tip()
 
     # transfer mastermix to strips
-    mm_strip = mm_strips.columns()[0]
+    if not PREPARE_MASTERMIX:
+        ctx.comment('Fill ' + mm_tube.display_name + ' with ' + \
+str(round(tube_vols[mm_tube])) + 'µl of mastermix.')
+    # destination columns served by each strip column, a strip well holds at
+    # most STRIP_MAX_VOL
+    strip_vol = mm_dict['volume']*((vol_overage-1)/2+1)
+    per_strip = int(STRIP_MAX_VOL//strip_vol)
+    dest_cols = sorted(set(d for _, _, d in transfers))
+    strip_cols = [dest_cols[k:k+per_strip]
+                  for k in range(0, len(dest_cols), per_strip)]
     if not p300.hw_pipette['has_tip']:
         pick_up(p300)
-    for i, well in enumerate(mm_strip):
-        if NUM_SAMPLES % 8 == 0 or i < NUM_SAMPLES % 8:
-            vol = num_cols*mm_dict['volume']*((vol_overage-1)/2+1)
-        else:
-            vol = (num_cols-1)*mm_dict['volume']*((vol_overage-1)/2+1)
-        p300.flow_rate.aspirate = 15
-        p300.transfer(vol, mm_tube.bottom(1), well, new_tip='never')
+    p300.flow_rate.aspirate = MM_FLOW if HEIGHT_TRACK and geometry else 15
+    # multi-dispense: the strip wells are filled in order with as few trips
+    # as the tips allow, a well is only split between trips when it does not
+    # fit in one. The 20µl tips have no room for the conditioning volume.
+    conditioning = CONDITIONING_VOL if SINGLE_PIPETTE == 'p300_single_gen2' \
+        else 0
+    max_load = tips300[0].wells()[0].max_volume - conditioning
+    trips = [[]]
+    load = 0
+    for g, cols in enumerate(strip_cols):
+        for i, well in enumerate(mm_strips.columns()[g]):
+            row_reactions = len([w for w in reaction_wells
+                                 if w % 8 == i and w//8 in cols])
+            vol_rem = row_reactions*strip_vol
+            if load > 0 and load + vol_rem > max_load:
+                trips.append([])
+                load = 0
+            while vol_rem > 0:
+                if load == max_load:
+                    trips.append([])
+                    load = 0
+                vol_trip = min(vol_rem, max_load - load)
+                vol_rem -= vol_trip
+                trips[-1].append((well, vol_trip))
+                load += vol_trip
+    for trip in trips:
+        trip_vol = sum(v for _, v in trip) + conditioning
+        p300.aspirate(trip_vol, h_track(mm_tube, trip_vol))
+        for well, v in trip:
+            p300.dispense(v, well.bottom(1))
+        # the conditioning volume goes back to the mastermix tube
+        if conditioning:
+            p300.dispense(conditioning, mm_tube.top(-2))
+            tube_vols[mm_tube] += conditioning
+    p300.blow_out(mm_tube.top(-2))
     p300.drop_tip()
 
     # transfer mastermix to plate
     mm_vol = mm_dict['volume']
     pick_up(m20)
-    m20.mix(5, mm_vol, mm_strip[0], 3)
-    m20.transfer(mm_vol, mm_strip[0].bottom(0.5), sample_dests,
-                 new_tip='never')
+    for g, cols in enumerate(strip_cols):
+        strip = mm_strips.rows()[0][g]
+        dests = [d for (_, _, c), d in zip(transfers, sample_dests) if c in cols]
+        m20.mix(5, mm_vol, strip, 3)
+        m20.transfer(mm_vol, strip.bottom(0.5),
+                     sorted(dests, key=lambda d: (d.top().point.x,
+                                                  -d.top().point.y)),
+                     new_tip='never')
     m20.drop_tip()
 
     # transfer samples to corresponding locations
-    for s, d in zip(sources, sample_dests):
+    await_temperature()
+    # every tip column goes to the nearest source column left, so the gantry
+    # travels the least between the tipracks, the source plates and the PCR
+    # plate
+    remaining = list(zip(sources, multi_dests))
+    while remaining:
+        tip = tip_log['tips'][m20][tip_log['count'][m20] % tip_log['max'][m20]]
+        s, d = min(remaining, key=lambda t: math.hypot(
+            t[0].top().point.x - tip.top().point.x,
+            t[0].top().point.y - tip.top().point.y))
+        remaining.remove((s, d))
         pick_up(m20)
-        m20.transfer(SAMPLE_VOL, s.bottom(1), d.bottom(1), new_tip='never')
-        m20.mix(1, 10, d.bottom(1))
+        m20.transfer(reaction['sample'], s.bottom(1), d.bottom(1),
+                     new_tip='never')
+        m20.mix(1, reaction['sample'], d.bottom(1))
         m20.blow_out(d.top(-2))
         m20.aspirate(5, d.top(2))  # suck in any remaining droplets on way to trash
         m20.drop_tip()
+    control_wells = [dest for _, dest in controls]
+    for p, c, d in transfers:
+        if d not in control_cols:
+            continue
+        for r, (s, w) in enumerate(zip(source_plates[p].columns()[c],
+                                       dest_wells(d))):
+            if w in control_wells or d*8 + r not in reaction_wells:
+                continue
+            pick_up(p300)
+            p300.transfer(reaction['sample'], s.bottom(1), w.bottom(1),
+                          new_tip='never')
+            p300.mix(1, reaction['sample'], w.bottom(1))
+            p300.blow_out(w.top(-2))
+            p300.drop_tip()
+
+    # controls with the single channel pipette, a new tip for each one
+    if mm_controls:
+        pick_up(p300)
+        for dest in mm_controls:
+            p300.aspirate(mm_vol, h_track(mm_tube, mm_vol))
+            p300.dispense(mm_vol, dest.bottom(1))
+        p300.drop_tip()
+    for tube, dest in controls:
+        pick_up(p300)
+        p300.aspirate(reaction['sample'], tube.bottom(1))
+        p300.dispense(reaction['sample'], dest.bottom(1))
+        p300.mix(1, reaction['sample'], dest.bottom(1))
+        p300.blow_out(dest.top(-2))
+        p300.drop_tip()
+
+    # plate map (well, content) for the qPCR software, in the order of the
+    # wells of the PCR plate
+    ctx.comment('Plate map: ' + str(len(plate_map) - len(controls)) + \
+' samples and ' + str(len(controls)) + ' controls.')
+    if not ctx.is_simulating():
+        if not os.path.isdir(folder_path):
+            os.mkdir(folder_path)
+        with open(folder_path + '/plate_map.csv', 'w') as map_file:
+            map_file.write('well,content\n')
+            for well in pcr_plate.wells():
+                if well in plate_map:
+                    map_file.write(well_names[well] + ',' + plate_map[well] + '\n')
 
     # track final used tip
     if TIP_TRACK and not ctx.is_simulating():
@@ -2,8 +2,9 @@ from opentrons.types import Point
 import json
 import os
 import math
+import socket
 import threading
-from time import sleep
+from time import monotonic, strftime
 
 metadata = {
     'protocolName': 'V1_Extração MagMax COVID - placas VWR',
@@ -12,7 +13,7 @@ metadata = {
     'apiLevel': '2.3'
 }
 
-NUM_SAMPLES = 40 # start with 8 samples, slowly increase to 48, then 94 (max is 64)
+NUM_SAMPLES = 40 # start with 8 samples, slowly increase to 48, then 94 (max is 64), total of both plates with PLATES = 2
 
 
 
@@ -21,315 +22,1478 @@ ELUTION_VOL = 50
 STARTING_VOL = 540
 WASH_VOL = 500
 POOL = False
+POOL_SIZE = 2  # samples per pool, as in the Station A pooling protocol
+POOL_COLUMN = 8  # column index of the first pool (8 is column 9), None for right after the samples
 TIP_TRACK = False
+COLUMN_TIP = 0  # first unused column of the first 300µl tiprack (0-11)
+RESUME = False  # continue a cancelled run from /data/B/checkpoint.json (remove any tip left on the pipette first)
 PARK = True
+PARKING_SLOTS = ['10']  # empty tipracks used for parking, in order of use
+MAX_TIP_REUSE = 1  # times a tip is picked up again from its parking spot after its first use, a tip at the limit is dropped instead of parked
+CONSOLIDATE_TRIPS = True  # supernatant trips go to the nearest point of the waste and only the last one blows out
+WASTES = [('11', 'nest_1_reservoir_195ml', 185000)]  # liquid waste (slot, labware, µl per well), every well is a destination
+RETURN_TIPS = True  # drop used tips into the emptied tipracks, the trash is only used when there is no room left
 LOCBOTTOM = 0.5
 SIDEBOTTOM = 0.3
-INCUBATION_TIME = 9
-DRY_TIME = 5
+INCUBATION_TIME = 9  # off magnet incubation, and settle time for magplates without a settle model
+DRY_TIME = 5  # longest air dry (minutes)
+ADAPTIVE_DRY = False  # air dry each column only as long as its residual EtOH needs, DRY_FILM and DRY_RATE are not calibrated yet
+DRY_FILM = 1.5  # µl of EtOH left on the well wall by each supernatant trip
+DRY_RATE = 60  # seconds of air dry per µl of residual EtOH
+DRY_MIN = 2  # shortest air dry (minutes)
 MAGHEIGHT = 4.75
+MULTI_DISPENSE = True  # add wash buffer and EtOH to all columns with one reagent tip
+HEIGHT_TRACK = True  # follow the liquid level down when removing supernatant
+FAST_FLOW = 94  # aspirate flow rate (µl/s) above the beads
+SLOW_VOL = 200  # last µl above the beads, aspirated at the slow flow rate
+MIX_STEPS = {'wash': 'flat_wash', 'etoh': 'flat_wash', 'elution': 'flat_elution'}  # mix profile of each step, see MIX_PROFILES, e.g. 'pellet_wash' and 'pellet_elution' to resuspend the pellet
+MIX_LABWARE = {}  # mix profile per (magplate labware, step), overrides MIX_STEPS, e.g. {('nest_96_wellplate_2ml_deep', 'wash'): 'pellet_wash'}
+FLASH = True  # flash the deck lights while the run is paused for the operator
+FLASH_PATTERN = [(True, 1), (False, 1)]  # (rail lights on, seconds) steps
+ALERT_ADDRESS = None  # ('<ip>', 5005) to send alerts to UTIL Opentrons APP/alert_listener.py
+SETTLE_OVERRIDES = {}  # settle minutes forced per liquid, e.g. {'etoh': 9}
+PLATES = 1  # deepwell plates in the run, the second one is pipetted during the incubations of the first
+MAG2_SLOT = '7'  # magnetic module of the second plate, replaces the tiprack in that slot
+ELUTION2_SLOT = None  # elution plate of the second plate (replaces a tiprack), None to elute into columns 7-12 of the chilled block
+ELUTION_MODE = 'column'  # 'column': elution buffer from the reservoir for each column, 'strip': from a strip filled at the start of the elution, 'multi': added to all columns with one tip before mixing
+ELUTION_STRIP_SLOT = '9'  # PCR strips of the 'strip' mode (replaces a tiprack), one strip per sample column
 #NÃO MEXER
 
+# Wash sequence (liquid, volume), shared by the planners and the run
+WASHES = [('wash', WASH_VOL), ('etoh', WASH_VOL), ('etoh', WASH_VOL)]
 
-# Definitions for deck light flashing
-class CancellationToken:
-    def __init__(self):
-       self.is_continued = False
+# Deepwell geometry for the liquid height model: cross section area of the
+# well (mm²) and height of its tapered bottom (mm), approximated as a cone
+DEEPWELL_GEOMETRY = {
+    'nest_96_wellplate_2ml_deep': {'area': 8.2*8.2, 'bottom': 4.0},
+    'vwr_96_wellplate_2000ul': {'area': math.pi*4.2**2, 'bottom': 4.2},
+    'starlab_96_wellplate_2000ul': {'area': 8.0*8.0, 'bottom': 4.0}
+}
+
+# Bead settling model per magplate: seconds the beads need on the magnet
+# plus seconds per mm of liquid above the magnet (MAGHEIGHT above the well
+# bottom), never less than a minimum (in seconds). Only magplates calibrated
+# on the robot belong here, e.g.
+#     'vwr_96_wellplate_2000ul': {'base': 60, 'per_mm': 60, 'min': 120}
+# Every other magplate waits INCUBATION_TIME on the magnet.
+SETTLE_MODEL = {}
+
+# settling time of the beads in each liquid relative to the lysate
+LIQUID_SETTLE_FACTOR = {'lysate': 1.0, 'wash': 0.9, 'etoh': 0.6,
+                        'elution': 0.8}
+
+# Mix profiles: every cycle of a profile aspirates and dispenses at (height
+# above the bottom in mm, offset in mm towards the bead pellet) with its own
+# (aspirate, dispense) flow rates in µl/s, and the cycles are repeated `reps`
+# times. The flat profiles are the former single location mixes.
+MIX_PROFILES = {
+    'flat_wash': {'reps': 15, 'cycles': [
+        {'aspirate': (LOCBOTTOM + 0.5, SIDEBOTTOM),
+         'dispense': (LOCBOTTOM + 0.5, SIDEBOTTOM), 'flow': (50, 150)}]},
+    'flat_elution': {'reps': 10, 'cycles': [
+        {'aspirate': (LOCBOTTOM, SIDEBOTTOM),
+         'dispense': (LOCBOTTOM, SIDEBOTTOM), 'flow': (50, 150)}]},
+    # aspirate at the bottom away from the pellet and dispense fast onto it,
+    # low and then higher up to wash down the beads left on the wall
+    'pellet_wash': {'reps': 6, 'cycles': [
+        {'aspirate': (LOCBOTTOM + 0.5, -SIDEBOTTOM),
+         'dispense': (3, 1.5), 'flow': (94, 300)},
+        {'aspirate': (LOCBOTTOM + 0.5, 0),
+         'dispense': (6, 2), 'flow': (94, 300)}]},
+    'pellet_elution': {'reps': 4, 'cycles': [
+        {'aspirate': (LOCBOTTOM, -SIDEBOTTOM),
+         'dispense': (2, 1), 'flow': (50, 150)},
+        {'aspirate': (LOCBOTTOM, 0),
+         'dispense': (LOCBOTTOM + 0.5, SIDEBOTTOM), 'flow': (50, 150)}]}
+}
+
+# length (mm) along x of the reservoir wells used as liquid waste
+RESERVOIR_WELL_LENGTH = {'nest_1_reservoir_195ml': 106.8,
+                         'nest_12_reservoir_15ml': 8.2}
+
+# volume (µl) left in each well of a reagent reservoir that the pipette
+# cannot aspirate
+RESERVOIR_DEAD_VOL = {'nest_12_reservoir_15ml': 1500,
+                      'nest_1_reservoir_195ml': 10000,
+                      'opentrons_96_aluminumblock_generic_pcr_strip_200ul': 5}
+
+# working volume (µl) a reagent reservoir well is filled to at most, below
+# the nominal volume so the well can be carried and pipetted without
+# spilling
+RESERVOIR_MAX_FILL = {'nest_12_reservoir_15ml': 13000,
+                      'nest_1_reservoir_195ml': 185000}
+
+
+# Definitions for deck light flashing and operator alerts
+class NotificationService:
+    """
+    `NotificationService` flashes the deck lights and records an alert event
+    while the run is paused for the operator. A single long-lived worker
+    thread waits on a `threading.Event`, so nothing runs between pauses.
+    :param hardware: The robot hardware, or None to not flash the lights.
+    :param pattern (List[tuple]): Flash pattern as (rail lights on, seconds)
+                                  steps, repeated while the alert lasts.
+    :param log_path (str): File the alert events are appended to, or None.
+    :param address (tuple): (host, port) the alert events are sent to over
+                            UDP, or None.
+    """
+
+    def __init__(self, hardware, pattern, log_path=None, address=None):
+        self._hardware = hardware
+        self._pattern = pattern
+        self._log_path = log_path
+        self._address = address
+        self._alert = threading.Event()
+        self._quiet = threading.Event()
+        self._quiet.set()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._flash, daemon=True)
+        self._worker.start()
+
+    def _flash(self):
+        while True:
+            self._alert.wait()
+            if self._stopped:
+                return
+            while self._alert.is_set() and not self._stopped:
+                for rails, seconds in self._pattern:
+                    if self._hardware:
+                        self._hardware.set_lights(rails=rails)
+                    if self._quiet.wait(seconds):
+                        break
+            if self._hardware:
+                self._hardware.set_lights(rails=False)
+
+    def _record(self, event, msg):
+        # alerts are best effort, they must never stop the run
+        line = json.dumps({'time': strftime('%Y-%m-%d %H:%M:%S'),
+                           'event': event, 'msg': msg})
+        try:
+            if self._log_path:
+                with open(self._log_path, 'a') as log_file:
+                    log_file.write(line + '\n')
+            if self._address:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.sendto(line.encode('utf-8'), self._address)
+                sock.close()
+        except OSError:
+            pass
+
+    def alert(self, msg):
+        self._record('pause', msg)
+        self._quiet.clear()
+        self._alert.set()
+
+    def clear(self):
+        self._alert.clear()
+        self._quiet.set()
+        self._record('resume', '')
+
+    def stop(self):
+        self._stopped = True
+        self._quiet.set()
+        self._alert.set()
+        self._worker.join()
 
-    def set_true(self):
-       self.is_continued = True
 
-    def set_false(self):
-       self.is_continued = False
+# Reagent inventory of the reservoirs
+class Reservoir:
+    """
+    `Reservoir` keeps the volume of every well of a reagent reservoir. Every
+    aspiration is drawn from the nearest well to its destination that still
+    has the volume above the dead volume, and `plan` gives the fill table for
+    the run.
+    :param name (str): Name of the reagent, for the fill table and pauses.
+    :param wells (List[Well]): The wells holding the reagent.
+    :param dead_vol (float): Volume (µl) that cannot be aspirated from a well.
+    :param max_trip (float): Largest volume (µl) drawn at once, the wells are
+                             filled with that margin.
+    :param max_fill (float): Working volume (µl) a well is filled to at most.
+    """
 
+    def __init__(self, name, wells, dead_vol, max_trip, max_fill):
+        self.name = name
+        self.wells = wells
+        self.dead_vol = dead_vol
+        self.max_trip = max_trip
+        self.max_fill = max_fill
+        self.fill = [0 for _ in wells]
+        self.vols = [0 for _ in wells]
+        self.short = 0  # demand (µl) the fill table does not cover
 
-def turn_on_blinking_notification(hardware, pause):
-    while pause.is_continued:
-        hardware.set_lights(rails=True)
-        sleep(1)
-        hardware.set_lights(rails=False)
-        sleep(1)
+    def nearest(self, loc):
+        """
+        `nearest` sorts the wells by their distance to a location.
+        :param loc (Location): The destination.
+        :return: The indices of the wells, nearest first.
+        """
+        return sorted(range(len(self.wells)), key=lambda w: math.hypot(
+            self.wells[w].top().point.x - loc.point.x,
+            self.wells[w].top().point.y - loc.point.y))
+
+    def plan(self, demand, loc):
+        """
+        `plan` adds a demand to the fill table. The nearest wells to the
+        destination are filled first, as they are drawn from first. Each well
+        in use keeps its dead volume and one trip of margin, which is the most
+        that can be left in it when a trip does not fit anymore.
+        :param demand (float): Volume (µl) that will be drawn.
+        :param loc (Location): Where the volume goes.
+        """
+        for w in self.nearest(loc):
+            if demand <= 0:
+                break
+            if self.fill[w] == 0:
+                self.fill[w] = self.dead_vol + self.max_trip
+            take = min(demand, self.max_fill - self.fill[w])
+            self.fill[w] += max(take, 0)
+            demand -= max(take, 0)
+        self.short += max(demand, 0)
+        self.vols = list(self.fill)
+
+    def draw(self, vol, loc):
+        """
+        `draw` takes a volume from the nearest well that has it.
+        :param vol (float): Volume (µl) of the aspiration, all channels.
+        :param loc (Location): Where the volume goes.
+        :return: The well to aspirate from, or None when no well has it.
+        """
+        for w in self.nearest(loc):
+            if self.vols[w] - vol >= self.dead_vol:
+                self.vols[w] -= vol
+                return self.wells[w]
+        return None
+
+    def refill(self):
+        self.vols = list(self.fill)
+
+    def drawn(self):
+        """
+        `drawn` gives the volume (µl) drawn since the reservoir was filled.
+        """
+        return sum(self.fill) - sum(self.vols)
+
+    def usable(self):
+        """
+        `usable` gives the volume (µl) that can surely be drawn from a full
+        reservoir, every well in use keeps its dead volume and up to one trip.
+        """
+        return sum(vol - self.dead_vol - self.max_trip
+                   for vol in self.fill if vol > 0)
+
+
+def plan_interventions(segments, used, limits, rack=None):
+    """
+    `plan_interventions` merges the operator interventions of a run (tip
+    replacement, emptying the tip and liquid waste, EtOH refill) into as few
+    pauses as possible. Pauses are only placed in incubation windows, as late
+    as possible. A pause restores the resources that would run out in the
+    next segment, and also the used resources that would run out before the
+    next pause those leave, when that saves the pause.
+    :param segments (List[dict]): Usage of each resource before the first
+                                  incubation window and after each window.
+    :param used (dict): Usage of each resource at the start of the run.
+    :param limits (dict): Usage of each resource that needs an intervention.
+    :param rack (int): Tip columns per tiprack when used tips are returned to
+                       the emptied tipracks (see `RETURN_TIPS`), None when all
+                       of them go to the trash. Tips are only counted as
+                       returned to the tipracks emptied before each segment.
+    :return: The resources to restore at each window index, and the indices
+             of the segments that will still need an unplanned pause.
+    """
+    used = dict(used)
+    plan = {}
+    unplanned = []
+    returned = 0
+
+    def trashed(segment, used, returned):
+        if not rack:
+            return segment
+        back = min(segment['drops']//8,
+                   (used['tips']//rack)*rack - returned)
+        return dict(segment, drops=segment['drops'] - 8*back)
+
+    def run_out(used, returned, start):
+        # first segment from `start` on that runs out a resource, and the
+        # resources it runs out
+        used = dict(used)
+        for m in range(start, len(segments)):
+            segment = trashed(segments[m], used, returned)
+            out = [r for r in limits if used[r] + segment[r] >= limits[r]]
+            if out:
+                return m, out
+            returned += (segments[m]['drops'] - segment['drops'])//8
+            for r in limits:
+                used[r] += segment[r]
+        return len(segments), []
+
+    def restored(restore):
+        return (dict(used, **{r: 0 for r in restore}),
+                0 if 'tips' in restore else returned)
+
+    for n, segment in enumerate(segments):
+        if n > 0:
+            m, out = run_out(used, returned, n)
+            restore = [r for r in out if m == n and used[r] > 0]
+            while restore:
+                _, later = run_out(*restored(restore), n)
+                if not later or set(later) & set(restore) or \
+                        any(used[r] == 0 for r in later):
+                    break
+                restore += later
+            if restore:
+                plan[n-1] = [r for r in limits if r in restore]
+                used, returned = restored(restore)
+        trash = trashed(segment, used, returned)
+        returned += (segment['drops'] - trash['drops'])//8
+        segment = trash
+        if any(used[r] + segment[r] >= limits[r] for r in limits):
+            unplanned.append(n)
+        for r in limits:
+            used[r] += segment[r]
+    return plan, unplanned
+
+
+def plan_usage(num_m, suffix=''):
+    """
+    `plan_usage` predicts the new tips, trashed tips, liquid waste and
+    EtOH of a plate before its first incubation window and after each
+    window, following `process` in run. All sample columns follow the same
+    tip path, so a single column is followed and its usage multiplied by the
+    number of columns.
+    :param num_m (int): Number of sample columns of the plate.
+    :param suffix (str): Added to the name of every window.
+    :return: The usage of each segment and the name of each window.
+    """
+    col = {'parked': PARK, 'uses': 0}
+    segments = [{'tips': 0, 'drops': 0, 'waste': 0, 'etoh': 0}]
+    windows = []
+
+    def window(name):
+        windows.append(name + suffix)
+        segments.append({'tips': 0, 'drops': 0, 'waste': 0, 'etoh': 0})
+
+    def pick(parked):  # as pick_up_for
+        if parked and col['parked']:
+            col['parked'] = False
+            col['uses'] += 1
+        else:
+            segments[-1]['tips'] += num_m
+            col['uses'] = 1
+
+    def release(park):  # as park_tip or drop
+        if park and col['uses'] <= MAX_TIP_REUSE:
+            col['parked'] = True
+        else:
+            segments[-1]['drops'] += 8*num_m
+
+    def reagent_tip():  # as add_reagent
+        segments[-1]['tips'] += 1
+        segments[-1]['drops'] += 8
+
+    def remove(vol):  # as remove_supernatant
+        pick(PARK)
+        release(False)
+        segments[-1]['waste'] += vol*8*num_m
+
+    window('the first magnet incubation')
+    remove(STARTING_VOL)
+    for n, (liquid, vol) in enumerate(WASHES):
+        if liquid == 'etoh':
+            segments[-1]['etoh'] += vol*8*num_m
+        if MULTI_DISPENSE:
+            reagent_tip()
+        pick(False)
+        release(PARK)
+        window('the magnet incubation of wash ' + str(n+1))
+        remove(vol+40)
+    window('the air dry')
+    if ELUTION_MODE in ['multi', 'strip']:
+        reagent_tip()
+    pick(False)
+    release(PARK)
+    window('the elution incubation off magnet')
+    window('the elution incubation on magnet')
+    pick(PARK)
+    release(False)
+    return segments, windows
+
+
+def tip_budget(plate_cols):
+    """
+    `tip_budget` counts the columns of new 300µl tips a run picks up, so that
+    only the tipracks it needs are loaded.
+    :param plate_cols (List[int]): Number of sample columns of each plate.
+    :return: The number of tip columns.
+    """
+    return sum(segment['tips'] for num_m in plate_cols
+               for segment in plan_usage(num_m)[0])
+
+
+def pool_layout(num_samples, pool_size, first_pool_col=8, rows=8, cols=12):
+    """
+    `pool_layout` describes a pooled sample plate, the same description is
+    used by the Station A pooling protocol and the POOL mode of Stations B and
+    C. The samples fill the plate column by column from A1 and are pooled in
+    order, pool_size at a time, into the wells from the top of first_pool_col.
+    When the samples do not divide evenly the last pool is smaller.
+    :param num_samples (int): Number of samples on the plate.
+    :param pool_size (int): Number of samples per pool (2, 4, 8...).
+    :param first_pool_col (int): Index of the first column of pools, None to
+                                 start the pools after the sample columns.
+    :param rows (int): Number of rows of the plate.
+    :param cols (int): Number of columns of the plate.
+    :return: The pools as (pool well index, sample well indices), and the
+             indices of the columns that hold samples or pools.
+    """
+    if pool_size < 2:
+        raise Exception('POOL_SIZE must be at least 2.')
+    num_cols = math.ceil(num_samples/rows)
+    if first_pool_col is None:
+        first_pool_col = num_cols
+    pools = [(first_pool_col*rows + n,
+              list(range(s, min(s + pool_size, num_samples))))
+             for n, s in enumerate(range(0, num_samples, pool_size))]
+    pool_cols = math.ceil(len(pools)/rows)
+    if num_cols > first_pool_col or first_pool_col + pool_cols > cols:
+        raise Exception(str(num_samples) + ' samples in pools of ' + \
+str(pool_size) + ' do not fit in the plate with the pools from column ' + \
+str(first_pool_col + 1) + '.')
+    return pools, list(range(num_cols)) + \
+        list(range(first_pool_col, first_pool_col + pool_cols))
+
+
+def nearest_dispense(top, length, loc, margin=5):
+    """
+    `nearest_dispense` gives the point at the top of a reservoir well, along
+    its length, that is nearest to a location. The 8 channels of the pipette
+    span the width of the well, so only x can move.
+    :param top (Location): Top center of the reservoir well.
+    :param length (float): Length (mm) of the well along x.
+    :param loc (Location): The location the pipette comes from.
+    :param margin (float): Distance (mm) kept from the ends of the well.
+    :return: The location to dispense at.
+    """
+    reach = max(length/2 - margin, 0)
+    return top.move(Point(x=min(max(loc.point.x - top.point.x, -reach), reach)))
 
-def create_thread(ctx, cancel_token):
-    t1 = threading.Thread(target=turn_on_blinking_notification, args=(ctx._hw_manager.hardware, cancel_token))
-    t1.start()
-    return t1
 
 # Start protocol
 def run(ctx):
-    # Setup for flashing lights notification to empty trash
-    # cancellationToken = CancellationToken()
+    if PLATES not in [1, 2]:
+        raise Exception('PLATES must be 1 or 2.')
+    if PLATES == 2 and POOL:
+        raise Exception('POOL is not available with 2 plates.')
+    if ELUTION_MODE not in ['column', 'strip', 'multi']:
+        raise Exception('ELUTION_MODE must be \'column\', \'strip\' or \'multi\'.')
+    # the second plate elutes into the second half of the chilled block
+    # unless it has its own elution plate
+    plate_max = 48 if PLATES == 2 and not ELUTION2_SLOT else 96
+    if NUM_SAMPLES > PLATES*plate_max:
+        raise Exception('Too many samples (' + str(NUM_SAMPLES) + ') for ' + \
+str(PLATES) + ' plate(s) of ' + str(plate_max) + ' samples.')
+    plate_samples = [min(NUM_SAMPLES, plate_max),
+                     NUM_SAMPLES - min(NUM_SAMPLES, plate_max)][:PLATES]
+    plate_sample_cols = []
+    for samples in plate_samples:
+        if samples == 0:
+            continue
+        if POOL:
+            plate_sample_cols.append(
+                pool_layout(samples, POOL_SIZE, POOL_COLUMN)[1])
+        else:
+            plate_sample_cols.append(list(range(math.ceil(samples/8))))
+    if ELUTION_MODE == 'strip' and sum(len(cols) for cols in plate_sample_cols) > 12:
+        raise Exception('The elution strips hold 12 sample columns, use \
+ELUTION_MODE \'column\' or \'multi\' for more.')
+
+    # first tip of the run, COLUMN_TIP or where the last run with TIP_TRACK
+    # stopped
+    first_tip = COLUMN_TIP
+    folder_path = '/data/B'
+    tip_file_path = folder_path + '/tip_log.json'
+    if TIP_TRACK and not ctx.is_simulating() and os.path.isfile(tip_file_path):
+        with open(tip_file_path) as json_file:
+            first_tip = json.load(json_file).get('tips300', COLUMN_TIP)
+
+    # tip budget, only the tipracks the run needs from the first tip on are
+    # loaded (the parking slots hold tips too when PARK is off)
+    tip_slots = [slot for slot in ['3', '6', '8', '9', '7']
+                 if slot not in PARKING_SLOTS + [w[0] for w in WASTES]]
+    if ELUTION_MODE == 'strip':
+        tip_slots = [slot for slot in tip_slots if slot != ELUTION_STRIP_SLOT]
+    if PLATES == 2:
+        tip_slots = [slot for slot in tip_slots
+                     if slot not in [MAG2_SLOT, ELUTION2_SLOT]]
+    if not PARK:
+        tip_slots = PARKING_SLOTS[::-1] + tip_slots
+    if first_tip >= 12*len(tip_slots):
+        ctx.comment('The tip log is past the last tiprack, the run starts \
+with new tipracks.')
+        first_tip = 0
+    tip_cols = tip_budget([len(cols) for cols in plate_sample_cols])
+    num_racks = max(1, min(len(tip_slots),
+                           math.ceil((first_tip + tip_cols)/12)))
+    tip_slots = tip_slots[:num_racks]
+    ctx.comment('The run uses ' + str(tip_cols) + ' columns of 300µl tips: \
+load tipracks on slot(s) ' + ', '.join(tip_slots) + ', the first tip is in \
+column ' + str(first_tip % 12 + 1) + ' of slot ' + tip_slots[first_tip//12] + \
+'.')
+    left = 12*num_racks - first_tip - tip_cols
+    if 0 < left < 12:
+        ctx.comment('The tiprack on slot ' + tip_slots[-1] + ' will keep ' + \
+str(left) + ' columns, use it as the first tiprack of the next run \
+with COLUMN_TIP = ' + str(12 - left) + '.')
 
     # load labware and pipettes
-    num_cols = math.ceil(NUM_SAMPLES/8)
     tips300 = [ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filtertiprack')
-               for slot in ['3', '6', '8', '9', '7']]
+               for slot in tip_slots]
     if PARK:
-        parkingrack = ctx.load_labware(
-            'opentrons_96_tiprack_300ul', '10', 'empty tiprack for parking')
-        if POOL:
-            parking_spots = parkingrack.rows()[0]
-        else:
-            parking_spots = parkingrack.rows()[0][:num_cols]
-    else:
-        tips300.insert(0, ctx.load_labware('opentrons_96_tiprack_300ul', '10',
-                                           '200µl filtertiprack'))
-        parking_spots = [None for none in range(12)]
+        parkingracks = [ctx.load_labware('opentrons_96_tiprack_300ul', slot,
+                                         'empty tiprack for parking')
+                        for slot in PARKING_SLOTS]
 
     m300 = ctx.load_instrument(
         'p300_multi_gen2', 'left', tip_racks=tips300)
 
-    magdeck = ctx.load_module('magnetic module gen2', '4')
-    magdeck.disengage()
+    magdecks = [ctx.load_module('magnetic module gen2', slot)
+                for slot in ['4', MAG2_SLOT][:PLATES]]
+    for magdeck in magdecks:
+        magdeck.disengage()
     magheight = MAGHEIGHT
     #magplate
-    magplate = magdeck.load_labware('vwr_96_wellplate_2000ul')
+    magplates = [magdeck.load_labware('vwr_96_wellplate_2000ul')
+                 for magdeck in magdecks]
     #magplate
     tempdeck = ctx.load_module('Temperature Module Gen2', '1')
     flatplate = tempdeck.load_labware(
                 'opentrons_96_aluminumblock_nest_wellplate_100ul',)
-    waste = ctx.load_labware('nest_1_reservoir_195ml', '11',
-                             'Liquid Waste').wells()[0].top()
+    if PLATES == 2 and ELUTION2_SLOT:
+        elutionplate2 = ctx.load_labware(
+            'opentrons_96_aluminumblock_nest_wellplate_100ul', ELUTION2_SLOT,
+            'elution plate of plate 2')
+        elution_cols = [flatplate.rows()[0], elutionplate2.rows()[0]]
+    else:
+        elution_cols = [flatplate.rows()[0], flatplate.rows()[0][6:]]
+    if ELUTION_MODE == 'strip':
+        elution_strip = ctx.load_labware(
+            'opentrons_96_aluminumblock_generic_pcr_strip_200ul',
+            ELUTION_STRIP_SLOT, 'elution buffer strips')
+    wastes = []
+    for slot, labware, capacity in WASTES:
+        for well in ctx.load_labware(labware, slot, 'Liquid Waste').wells():
+            wastes.append({'top': well.top(), 'capacity': capacity,
+                           'length': RESERVOIR_WELL_LENGTH.get(labware, 0)})
+    waste_slots = ', '.join(slot for slot, _, _ in WASTES)
     etoh = ctx.load_labware(
         'nest_1_reservoir_195ml', '2', 'EtOH reservoir').wells()[0:]
     res1 = ctx.load_labware(
         'nest_12_reservoir_15ml', '5', 'reagent reservoir 1')
-    wash1 = res1.wells()[:4]
+    # wash buffer in A1-A11, split between the plates with PLATES = 2, the
+    # fill table only uses the wells a run needs
+    wash1 = [res1.wells()[:11]] if PLATES == 1 else \
+        [res1.wells()[:6], res1.wells()[6:11]]
     elution_solution = res1.wells()[-1]
 
-    if POOL:
-        mag_samples_m = magplate.rows()[0][:num_cols] + magplate.rows()[0][8:8+math.ceil(num_cols/2)]
-        elution_samples_m = flatplate.rows()[0][:num_cols] + flatplate.rows()[0][8:8+math.ceil(num_cols/2)]
-    else:
-        mag_samples_m = magplate.rows()[0][:num_cols]
-        elution_samples_m = flatplate.rows()[0][:num_cols]
+    # sample columns of all plates, each plate keeps the indices of its own
+    mag_samples_m = []
+    elution_samples_m = []
+    col_nums = []
+    plates = []
+    for p, sample_cols in enumerate(plate_sample_cols):
+        first = len(mag_samples_m)
+        mag_samples_m += [magplates[p].rows()[0][c] for c in sample_cols]
+        elution_samples_m += [elution_cols[p][c] for c in sample_cols]
+        col_nums += sample_cols
+        plates.append({
+            'name': 'plate ' + str(p+1),
+            'magdeck': magdecks[p],
+            'magplate': magplates[p],
+            'cols': list(range(first, len(mag_samples_m))),
+            'wash': wash1[p],
+            'etoh': etoh
+        })
+
+    # location cache: every location used on a sample column is computed once
+    # here. The beads pellet on the side of the well given by the column
+    # number, the supernatant is aspirated away from the pellet and the mixes
+    # are dispensed against it.
+    locs = []
+    for c, m, e in zip(col_nums, mag_samples_m, elution_samples_m):
+        side = 1 if (c+1) % 2 == 0 else -1
+        locs.append({
+            'top': m.top(),
+            'center': m.center(),
+            'supernatant': m.bottom().move(Point(x=side*SIDEBOTTOM)),
+            'resuspend': m.bottom(LOCBOTTOM).move(Point(x=-side*SIDEBOTTOM)),
+            'eluate': m.bottom(LOCBOTTOM).move(Point(x=side*SIDEBOTTOM)),
+            'blow_out': m.bottom(5),
+            'elution_dispense': e.bottom(5),
+            'elution_blow_out': e.top(-2)
+        })
+    # elution strip well of each sample column, filled with its elution
+    # buffer and the dead volume of the strip
+    elution_add = ELUTION_VOL
+    if ELUTION_MODE == 'strip':
+        elution_add += RESERVOIR_DEAD_VOL[elution_strip.load_name]
+        for loc, well in zip(locs, elution_strip.rows()[0]):
+            loc['stage'] = well.bottom(0.5)
+            loc['stage_top'] = well.top()
+    # mix profile of every step for each column, with the offsets towards the
+    # bead pellet
+    for plate in plates:
+        for i in plate['cols']:
+            pellet = -1 if (col_nums[i]+1) % 2 == 0 else 1
+            locs[i]['mixes'] = {}
+            for step, name in MIX_STEPS.items():
+                profile = MIX_PROFILES[MIX_LABWARE.get(
+                    (plate['magplate'].load_name, step), name)]
+                locs[i]['mixes'][step] = (profile['reps'], [(
+                    mag_samples_m[i].bottom(cycle['aspirate'][0]).move(
+                        Point(x=pellet*cycle['aspirate'][1])),
+                    mag_samples_m[i].bottom(cycle['dispense'][0]).move(
+                        Point(x=pellet*cycle['dispense'][1])),
+                    cycle['flow']) for cycle in profile['cycles']])
+
+    # reagent inventory: wash buffer per plate, EtOH and elution buffer are
+    # shared. The fill table covers the volume of every column with the
+    # nearest wells filled first.
+    def reagent_name(name, plate):
+        return name + (' of ' + plate['name'] if len(plates) > 1 else '')
+
+    etoh_res = Reservoir('EtOH', etoh,
+                         RESERVOIR_DEAD_VOL['nest_1_reservoir_195ml'], 8*200,
+                         RESERVOIR_MAX_FILL['nest_1_reservoir_195ml'])
+    elution_res = Reservoir('elution buffer', [elution_solution],
+                            RESERVOIR_DEAD_VOL['nest_12_reservoir_15ml'], 8*200,
+                            RESERVOIR_MAX_FILL['nest_12_reservoir_15ml'])
+    for plate in plates:
+        plate['wash'] = Reservoir(reagent_name('wash buffer', plate),
+                                  plate['wash'],
+                                  RESERVOIR_DEAD_VOL['nest_12_reservoir_15ml'],
+                                  8*200,
+                                  RESERVOIR_MAX_FILL['nest_12_reservoir_15ml'])
+        plate['etoh'] = etoh_res
+        dest = locs[plate['cols'][0]]['top']
+        for liquid, vol in WASHES:
+            plate[liquid].plan(8*vol*len(plate['cols']), dest)
+        elution_res.plan(8*elution_add*len(plate['cols']), dest)
+    reservoirs = [plate['wash'] for plate in plates] + [etoh_res, elution_res]
+    ctx.comment('Reagent fill table:')
+    for res in reservoirs:
+        ctx.comment(res.name + ': ' + ', '.join(
+            str(round(vol)) + 'µl in ' + well.display_name
+            for well, vol in zip(res.wells, res.fill) if vol > 0) + '.')
+        if res.short > 0 and res is not etoh_res:
+            ctx.comment(str(round(res.short)) + 'µl more ' + res.name + ' \
+than the wells hold are needed, the run will pause for a refill.')
+
+    # liquid waste destinations of each sample column, nearest first
+    for loc in locs:
+        loc['wastes'] = sorted(range(len(wastes)), key=lambda w: math.hypot(
+            wastes[w]['top'].point.x - loc['top'].point.x,
+            wastes[w]['top'].point.y - loc['top'].point.y))
+        loc['waste_points'] = [
+            nearest_dispense(w['top'], w['length'], loc['top'])
+            if CONSOLIDATE_TRIPS else w['top'] for w in wastes]
+    trash = ctx.loaded_labwares[12].wells()[0].top()
+    drop_locs = [trash.move(Point(x=30)), trash.move(Point(x=-18))]
+
+    # parking ledger: parking spot of each sample column, whether a tip is
+    # parked there and how many times the tip of the column has been picked
+    # up. Only the tip that mixed a column is parked, for the supernatant
+    # removal of the same liquid.
+    park_log = {'spots': [None for _ in mag_samples_m]}
+    if PARK:
+        spots = [spot for rack in parkingracks for spot in rack.rows()[0]]
+        if len(spots) < len(mag_samples_m):
+            raise Exception('Not enough parking spots (' + str(len(spots)) + ') \
+for ' + str(len(mag_samples_m)) + ' sample columns, add a parking rack to \
+PARKING_SLOTS.')
+        park_log['spots'] = spots[:len(mag_samples_m)]
+    # tips for the first supernatant removal are loaded in the parking spots
+    park_log['parked'] = [PARK for _ in mag_samples_m]
+    park_log['uses'] = [0 for _ in mag_samples_m]
 
-    magdeck.disengage()  # just in case
+    for magdeck in magdecks:
+        magdeck.disengage()  # just in case
     #tempdeck.set_temperature(20)
 
+    # liquid volume (µl) in the wells of each sample column
+    well_vol = [STARTING_VOL for _ in mag_samples_m]
+    geometry = DEEPWELL_GEOMETRY.get(magplates[0].load_name)
+    # last supernatant removal of each sample column: when it ended, the
+    # height of its last aspiration and its number of trips
+    last_removal = {'time': [0 for _ in mag_samples_m],
+                    'height': [LOCBOTTOM for _ in mag_samples_m],
+                    'trips': [0 for _ in mag_samples_m]}
+
+    def liquid_height(vol):
+        """
+        `liquid_height` translates a volume in a magplate well into the height
+        (in mm) of the meniscus above the bottom of the well.
+        :param vol (float): The volume of liquid in the well.
+        """
+        bottom_vol = geometry['area']*geometry['bottom']/3
+        if vol <= bottom_vol:
+            return geometry['bottom']*(max(vol, 0)/bottom_vol)**(1/3)
+        return geometry['bottom'] + (vol - bottom_vol)/geometry['area']
+
+    def liquid_volume(height):
+        """
+        `liquid_volume` is the inverse of `liquid_height`: the volume of
+        liquid in a magplate well up to a height (in mm) above its bottom.
+        :param height (float): The height of the meniscus.
+        """
+        bottom_vol = geometry['area']*geometry['bottom']/3
+        if height <= geometry['bottom']:
+            return bottom_vol*(max(height, 0)/geometry['bottom'])**3
+        return bottom_vol + (height - geometry['bottom'])*geometry['area']
+
+    def aspirate_supernatant(i, vol):
+        """
+        `aspirate_supernatant` aspirates supernatant just below the meniscus,
+        following the liquid down at `FAST_FLOW` and only slowing down for the
+        last `SLOW_VOL` above the beads.
+        :param i (int): Index of the sample column.
+        :param vol (float): The amount of volume to aspirate.
+        """
+        if HEIGHT_TRACK and geometry:
+            fast_vol = min(vol, max(well_vol[i] - SLOW_VOL, 0))
+        else:
+            fast_vol = 0
+        for asp_vol, flow in [(fast_vol, FAST_FLOW), (vol - fast_vol, 30)]:
+            if asp_vol <= 0:
+                continue
+            height = LOCBOTTOM
+            if HEIGHT_TRACK and geometry:
+                # meniscus at the end of this aspiration, minus 2mm immersion
+                height = max(liquid_height(well_vol[i] - asp_vol) - 2,
+                             LOCBOTTOM)
+            m300.flow_rate.aspirate = flow
+            m300.aspirate(asp_vol, locs[i]['supernatant'].move(
+                Point(z=height)))
+            well_vol[i] = max(well_vol[i] - asp_vol, 0)
+            last_removal['height'][i] = height
+
     m300.flow_rate.aspirate = 50
     m300.flow_rate.dispense = 150
     m300.flow_rate.blow_out = 300
 
-    folder_path = '/data/B'
-    tip_file_path = folder_path + '/tip_log.json'
-    tip_log = {'count': {}}
-    if TIP_TRACK and not ctx.is_simulating():
-        if os.path.isfile(tip_file_path):
-            with open(tip_file_path) as json_file:
-                data = json.load(json_file)
-                if 'tips300' in data:
-                    tip_log['count'][m300] = data['tips300']
-                else:
-                    tip_log['count'][m300] = 0
-        else:
-            tip_log['count'][m300] = 0
-    else:
-        tip_log['count'] = {m300: 0}
+    if not ctx.is_simulating() and not os.path.isdir(folder_path):
+        os.mkdir(folder_path)
+
+    # deck lights and alerts while the run is paused for the operator
+    notifier = NotificationService(
+        ctx._hw_manager.hardware if FLASH and not ctx.is_simulating() else None,
+        FLASH_PATTERN,
+        log_path=None if ctx.is_simulating() else folder_path + '/alerts.log',
+        address=None if ctx.is_simulating() else ALERT_ADDRESS)
+
+    def operator_pause(msg):
+        """
+        `operator_pause` pauses the run for the operator. The deck lights
+        flash and an alert is recorded until the run is resumed.
+        :param msg (str): Message shown to the operator.
+        """
+        notifier.alert(msg)
+        m300.home()
+        ctx.pause(msg)
+        ctx.home()  # home before continuing with protocol
+        notifier.clear()
+    tip_log = {'count': {m300: first_tip}}
 
     tip_log['tips'] = {
         m300: [tip for rack in tips300 for tip in rack.rows()[0]]}
     tip_log['max'] = {m300: len(tip_log['tips'][m300])}
+    # used tips returned to the emptied tipracks, into the first columns of
+    # tip_log['tips'] (see RETURN_TIPS)
+    tip_log['returned'] = {m300: 0}
+    rack_cols = len(tips300[0].rows()[0])
 
     def pick_up(pip, loc=None):
         nonlocal tip_log
-        if tip_log['count'][pip] == tip_log['max'][pip] and not loc:
-            ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-resuming.')
+        if tip_log['count'][pip] >= tip_log['max'][pip] and not loc:
+            operator_pause('Replace ' + str(pip.max_volume) + 'µl tipracks \
+before resuming.')
             pip.reset_tipracks()
             tip_log['count'][pip] = 0
+            tip_log['returned'][pip] = 0
         if loc:
             pip.pick_up_tip(loc)
         else:
             pip.pick_up_tip(tip_log['tips'][pip][tip_log['count'][pip]])
             tip_log['count'][pip] += 1
+        save_checkpoint()
+
+    def pick_up_for(pip, i, parked=False):
+        """
+        `pick_up_for` picks up the tip of sample column `i`: the tip parked in
+        its parking spot if there is one, otherwise a new tip.
+        :param i (int): Index of the sample column.
+        :param parked (boolean): Whether the parked tip may be used.
+        """
+        if parked and park_log['parked'][i]:
+            park_log['parked'][i] = False
+            park_log['uses'][i] += 1
+            pick_up(pip, park_log['spots'][i])
+        else:
+            park_log['uses'][i] = 1
+            pick_up(pip)
+
+    def park_tip(pip, i):
+        """
+        `park_tip` parks the tip of sample column `i` in its parking spot, or
+        drops it when it has been reused `MAX_TIP_REUSE` times.
+        :param i (int): Index of the sample column.
+        """
+        if park_log['uses'][i] > MAX_TIP_REUSE:
+            drop(pip)
+            return
+        pip.drop_tip(park_log['spots'][i])
+        park_log['parked'][i] = True
+        save_checkpoint()
 
     switch = True
     drop_count = 0
     drop_threshold = 240  # number of tips trash will accommodate before prompting user to empty
 
     def drop(pip):
+        """
+        `drop` returns the tip to a tiprack that has been emptied by now, or
+        drops it in the trash when there is none.
+        """
         nonlocal switch
         nonlocal drop_count
-        side = 30 if switch else -18
-        drop_loc = ctx.loaded_labwares[12].wells()[0].top().move(
-            Point(x=side))
-        pip.drop_tip(drop_loc)
+        emptied = (tip_log['count'][pip]//rack_cols)*rack_cols
+        if RETURN_TIPS and tip_log['returned'][pip] < emptied:
+            pip.drop_tip(tip_log['tips'][pip][tip_log['returned'][pip]])
+            tip_log['returned'][pip] += 1
+            return
+        pip.drop_tip(drop_locs[0] if switch else drop_locs[1])
         switch = not switch
         drop_count += 8
         if drop_count == drop_threshold:
-            # Setup for flashing lights notification to empty trash
-            # if not ctx._hw_manager.hardware.is_simulator:
-            #     cancellationToken.set_true()
-            # thread = create_thread(ctx, cancellationToken)
-            m300.home()
-            ctx.pause('Please empty tips from waste before resuming.')
-
-            ctx.home()  # home before continuing with protocol
-            # cancellationToken.set_false()  # stop light flashing after home
-            # thread.join()
+            # unplanned, see plan_interventions
+            operator_pause('Please empty tips from waste before resuming.')
             drop_count = 0
 
-    waste_vol = 0
-    waste_threshold = 185000
+    # a waste destination is passed over when the next trip does not fit, so
+    # up to one trip of room is left in all of them but the last
+    waste_vols = [0 for _ in wastes]
+    waste_threshold = sum(w['capacity'] for w in wastes) - 200*(len(wastes) - 1)
+    def reagent(res, vol, loc):
+        """
+        `reagent` picks the reservoir well of an aspiration, see `Reservoir`.
+        The run is paused for a refill if no well has the volume left.
+        :param res (Reservoir): The reagent.
+        :param vol (float): Volume of the aspiration (all 8 channels).
+        :param loc (Location): Where the volume goes.
+        :return: The well to aspirate from.
+        """
+        well = res.draw(vol, loc)
+        if well is None:
+            # unplanned, the fill table covers the whole run
+            operator_pause('Please refill ' + res.name + ' as in the fill \
+table before resuming.')
+            res.refill()
+            well = res.draw(vol, loc)
+        return well
+
+    # progress of the run, saved after every column and every tip movement so
+    # a cancelled run can be continued with RESUME
+    checkpoint_path = folder_path + '/checkpoint.json'
+    checkpoint = {
+        'config': {'samples': NUM_SAMPLES, 'plates': PLATES, 'pool': POOL,
+                   'elution2_slot': ELUTION2_SLOT, 'elution_mode': ELUTION_MODE,
+                   'park': PARK, 'max_tip_reuse': MAX_TIP_REUSE,
+                   'multi_dispense': MULTI_DISPENSE,
+                   'washes': [list(wash) for wash in WASHES]},
+        'done': {}
+    }
+
+    def save_checkpoint():
+        """
+        `save_checkpoint` writes the progress, tips, parking and liquid state
+        of the run to /data/B/checkpoint.json. The checkpoint is written to a
+        temporary file that then replaces the old one, so a crash never
+        leaves a half written checkpoint.
+        """
+        if ctx.is_simulating():
+            return
+        checkpoint['state'] = {
+            'tips': tip_log['count'][m300], 'parked': park_log['parked'],
+            'uses': park_log['uses'],
+            'drops': drop_count,
+            'returned': tip_log['returned'][m300],
+            'switch': switch, 'waste': waste_vols,
+            'well_vol': well_vol, 'height': last_removal['height'],
+            'trips': last_removal['trips'],
+            'reagents': [res.vols for res in reservoirs]
+        }
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(tmp_path, checkpoint_path)
+
+    def pending(key, cols):
+        """
+        `pending` lists the sample columns that a step has not done yet.
+        :param key (str): The step, e.g. 'plate 1/wash 2/remove'.
+        :param cols (List[int]): Indices of the sample columns.
+        """
+        return [i for i in cols if i not in checkpoint['done'].get(key, [])]
+
+    def mark(key, i):
+        """
+        `mark` records that a step is done for sample column `i`.
+        :param key (str): The step, e.g. 'plate 1/wash 2/remove'.
+        :param i (int): Index of the sample column.
+        """
+        checkpoint['done'].setdefault(key, []).append(i)
+        save_checkpoint()
+
+    # incubation windows so far, the planned operator interventions run in
+    # them
+    window_count = 0
+    interventions = {}  # planned operator interventions per window
+    intervention_msgs = {
+        'tips': 'replace ' + str(m300.max_volume) + 'µl tipracks',
+        'drops': 'empty tips from waste',
+        'waste': 'empty liquid waste (slot ' + waste_slots + ')',
+        'etoh': 'refill EtOH reservoir (slot 2)'
+    }
+
+    def settle_time(liquid, plate):
+        """
+        `settle_time` chooses how long the beads stay on the magnet, from the
+        liquid column above the magnet in the fullest sample column. The
+        chosen time is commented and appended to /data/B/settle_log.json.
+        :param liquid (str): Liquid the beads are in ('lysate', 'wash',
+                             'etoh' or 'elution').
+        :param plate (dict): The plate on the magnet.
+        :return: The settle time in minutes.
+        """
+        magplate = plate['magplate']
+        max_vol = max(well_vol[i] for i in plate['cols'])
+        model = SETTLE_MODEL.get(magplate.load_name)
+        height = liquid_height(max_vol) if geometry else None
+        if liquid in SETTLE_OVERRIDES:
+            minutes = SETTLE_OVERRIDES[liquid]
+            reason = 'override'
+        elif model and geometry:
+            seconds = model['base'] + model['per_mm']*max(height - MAGHEIGHT, 0)
+            minutes = max(seconds*LIQUID_SETTLE_FACTOR[liquid],
+                          model['min'])/60
+            reason = str(round(max_vol)) + 'µl, ' + \
+                str(round(height, 1)) + 'mm liquid'
+        else:
+            minutes = INCUBATION_TIME
+            reason = 'no settle model for ' + magplate.load_name
+        ctx.comment('Settle time in ' + liquid + ': ' + str(round(minutes, 1)) + \
+' minutes (' + reason + ').')
+        if not ctx.is_simulating():
+            with open(folder_path + '/settle_log.json', 'a') as settle_file:
+                settle_file.write(json.dumps({
+                    'time': strftime('%Y-%m-%d %H:%M:%S'),
+                    'labware': magplate.load_name, 'liquid': liquid,
+                    'volume': max_vol, 'magheight': MAGHEIGHT,
+                    'minutes': minutes, 'reason': reason}) + '\n')
+        return minutes
+
+    def incubate(minutes, msg):
+        """
+        `incubate` runs the operator intervention planned for the incubation
+        window, if any, and only delays for the time that is left.
+        :param minutes (float): Length of the incubation window.
+        :param msg (str): Message shown during the remaining delay.
+        """
+        nonlocal window_count
+        nonlocal sim_time
+        window = minutes*60
+        sim_time += window
+        used = 0
+        if window_count in interventions:
+            # planned interventions run even when the window is too short
+            ctx.comment('Planned operator intervention.')
+            start = monotonic()
+            intervene(interventions[window_count])
+            used += 5 if ctx.is_simulating() else monotonic() - start
+        window_count += 1
+        if window - used > 0:
+            if used > 0:
+                msg += ' (' + str(round((window - used)/60, 1)) + ' minutes left \
+after the intervention)'
+            ctx.delay(seconds=window - used, msg=msg)
+
+    sim_time = 0  # seconds of incubation windows elapsed in simulation
+
+    def clock():
+        return sim_time if ctx.is_simulating() else monotonic()
+
+    def dry_time(i):
+        """
+        `dry_time` is the air dry a sample column needs after its last
+        supernatant removal: the EtOH left below its last aspiration plus the
+        film left by every trip, between `DRY_MIN` and `DRY_TIME`.
+        :param i (int): Index of the sample column.
+        :return: The air dry time in minutes.
+        """
+        residual = DRY_FILM*last_removal['trips'][i]
+        if geometry:
+            residual += liquid_volume(last_removal['height'][i])
+        return min(max(residual*DRY_RATE/60, DRY_MIN), DRY_TIME)
+
+    def wait_dry(i):
+        """
+        `wait_dry` waits until sample column `i` has been drying for its own
+        `dry_time`, counted from the end of its last supernatant removal.
+        :param i (int): Index of the sample column.
+        """
+        nonlocal sim_time
+        left = last_removal['time'][i] + dry_time(i)*60 - clock()
+        if left > 0:
+            ctx.delay(seconds=left, msg='Airdrying beads of column ' + \
+str(i+1) + ' for ' + str(round(left/60, 1)) + ' more minutes.')
+            sim_time += left
+
+    def run_plates(pipelines):
+        """
+        `run_plates` runs the plates in turns. Every pipeline pipettes up to
+        its next incubation, and while a plate incubates the other plate is
+        pipetted, so only the time that is left of an incubation is spent
+        waiting in `incubate`. A plate may stay a bit longer than its
+        incubation time (on the magnet, off the magnet or drying) when the
+        other plate takes longer to pipette.
+        :param pipelines (List[tuple]): The plate and its pipeline, a
+                                        generator that yields the length (in
+                                        minutes) and message of each
+                                        incubation.
+        """
+        ends = [None for _ in pipelines]  # end of each pending incubation
+        msgs = [None for _ in pipelines]
+        active = list(range(len(pipelines)))
+        while active:
+            for n in list(active):
+                plate, pipeline = pipelines[n]
+                if ends[n] is not None:
+                    incubate(max(ends[n] - clock(), 0)/60, msgs[n])
+                try:
+                    minutes, msg = next(pipeline)
+                except StopIteration:
+                    active.remove(n)
+                    continue
+                if len(pipelines) > 1:
+                    msg = plate['name'] + ': ' + msg
+                ends[n] = clock() + minutes*60
+                msgs[n] = msg
+
+    def intervene(resources):
+        """
+        `intervene` asks for all the interventions planned for an incubation
+        window in one single pause.
+        :param resources (List[str]): Resources to restore ('tips', 'drops'
+                                      and/or 'waste').
+        """
+        nonlocal drop_count
+        operator_pause('Please ' + ', '.join(
+            intervention_msgs[r] for r in resources) + ' before resuming.')
+        if 'tips' in resources:
+            m300.reset_tipracks()
+            tip_log['count'][m300] = 0
+            tip_log['returned'][m300] = 0
+        if 'drops' in resources:
+            drop_count = 0
+        if 'waste' in resources:
+            waste_vols[:] = [0 for _ in wastes]
+        if 'etoh' in resources:
+            etoh_res.refill()
 
-    def remove_supernatant(vol, park=False):
 
-        def waste_track(vol):
-            nonlocal waste_vol
-            if waste_vol + vol >= waste_threshold:
-                # Setup for flashing lights notification to empty liquid waste
-                # if not ctx._hw_manager.hardware.is_simulator:
-                #     cancellationToken.set_true()
-                # thread = create_thread(ctx, cancellationToken)
-                m300.home()
-                ctx.pause('Please empty liquid waste (slot 11) before resuming.')
+    def remove_supernatant(plate, vol, park=False, key='remove'):
+        """
+        `remove_supernatant` transfers supernatant from the magplate to the
+        liquid waste. The tips are always dropped, a tip that removed
+        supernatant never goes back into a clean wash.
+        :param plate (dict): The plate to remove the supernatant from.
+        :param vol (float): The amount of volume to remove from each column.
+        :param park (boolean): Whether to use the tips parked for each column.
+        :param key (str): Checkpoint key of the step.
+        """
 
-                ctx.home()  # home before continuing with protocol
-                # cancellationToken.set_false() # stop light flashing after home
-                # thread.join()
-                waste_vol = 0
-            waste_vol += vol
+        def waste_track(i, vol):
+            """
+            `waste_track` picks the liquid waste of a trip: the nearest one
+            to the sample column with room for it. The run is only paused
+            when all of them are full.
+            :param i (int): Index of the sample column.
+            :param vol (float): Volume of the trip (all 8 channels).
+            :return: The location to dispense the trip to.
+            """
+            room = [w for w in locs[i]['wastes']
+                    if waste_vols[w] + vol < wastes[w]['capacity']]
+            if not room:
+                # unplanned, see plan_interventions
+                operator_pause('Please empty liquid waste (slot ' + \
+waste_slots + ') before resuming.')
+                waste_vols[:] = [0 for _ in wastes]
+                room = locs[i]['wastes']
+            waste_vols[room[0]] += vol
+            return locs[i]['waste_points'][room[0]]
 
         m300.flow_rate.aspirate = 30
         num_trans = math.ceil(vol/200)
         vol_per_trans = vol/num_trans
-        for m, spot in zip(mag_samples_m, parking_spots):
-            if park:
-                pick_up(m300, spot)
-            else:
-                pick_up(m300)
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = 1 if side_ind % 2 == 0 else -1
-            loc = m.bottom(LOCBOTTOM).move(Point(x=side*SIDEBOTTOM)) # mudei de LOCBOTTOM  3>2.5
+        for i in pending(key, plate['cols']):
+            pick_up_for(m300, i, park)
             for _ in range(num_trans):
-                waste_track(vol_per_trans)
+                waste = waste_track(i, vol_per_trans*8)
                 if m300.current_volume > 0:
-                    m300.dispense(m300.current_volume, m.top())  # void air gap if necessary
-                m300.move_to(m.center())
-                m300.transfer(vol_per_trans, loc, waste, new_tip='never',
-                              air_gap=10)
-                #m300.blow_out(waste)
+                    # void air gap, on the way down when trips are consolidated
+                    m300.dispense(m300.current_volume,
+                                  locs[i]['center'] if CONSOLIDATE_TRIPS else locs[i]['top'])
+                m300.move_to(locs[i]['center'])
+                aspirate_supernatant(i, vol_per_trans)
                 m300.air_gap(10)
+                m300.dispense(m300.current_volume, waste)
+                #m300.blow_out(waste)
+                if CONSOLIDATE_TRIPS:
+                    # air gap where the trip was dispensed, air_gap() would
+                    # go back to the center of the waste
+                    m300.aspirate(10, waste.move(Point(z=5)))
+                else:
+                    m300.air_gap(10)
+            last_removal['trips'][i] = num_trans
+            last_removal['time'][i] = clock()
             drop(m300)
+            mark(key, i)
         m300.flow_rate.aspirate = 50  # mudei de 150
 
+    def add_reagent(plate, vol, source, max_load=180, dest='top', key='add'):
+        """
+        `add_reagent` dispenses reagent from the top of every sample column
+        with one dedicated tip that never touches the samples. Trips are
+        filled up to `max_load` and may serve the end of one column and the
+        start of the next one.
+        :param plate (dict): The plate to dispense to.
+        :param vol (float): The amount of volume to dispense in each column.
+        :param source (Reservoir): The reagent.
+        :param max_load (float): Reagent volume per trip (leaves room for the
+                                 20µl air gap in the 200µl filter tips).
+        :param dest (str): Location of each column to dispense at, from the
+                           location cache ('top' or 'stage_top').
+        :param key (str): Checkpoint key of the step.
+        """
+        cols = pending(key, plate['cols'])
+        if not cols:
+            return
+        trips = [[]]
+        load = 0
+        for j, i in enumerate(plate['cols']):
+            if i not in cols:
+                continue
+            vol_rem = vol
+            while vol_rem > 0:
+                if load == max_load:
+                    trips.append([])
+                    load = 0
+                vol_trip = min(vol_rem, max_load - load)
+                vol_rem -= vol_trip
+                trips[-1].append((j, i, vol_trip, vol_rem == 0))
+                load += vol_trip
 
-    def wash(wash_vol, source, mix_reps, park=True):
-        magdeck.disengage()
+        pick_up(m300)
+        for trip in trips:
+            trip_vol = sum(v for _, _, v, _ in trip)
+            src = reagent(source, 8*trip_vol, locs[trip[0][1]][dest])
+            m300.aspirate(trip_vol, src.bottom(0.8))
+            for _, i, v, last in trip:
+                m300.air_gap(20)
+                m300.dispense(v + 20, locs[i][dest])  # dispense with the air gap
+                if last:
+                    mark(key, i)
+        m300.blow_out(locs[trip[-1][1]][dest])
+        drop(m300)
+
+    def mix_profile(i, step, vol):
+        """
+        `mix_profile` resuspends the beads of a sample column with the mix
+        profile of a step, see `MIX_PROFILES`.
+        :param i (int): Index of the sample column.
+        :param step (str): The step, 'wash', 'etoh' or 'elution'.
+        :param vol (float): The mix volume.
+        """
+        flow = (m300.flow_rate.aspirate, m300.flow_rate.dispense)
+        reps, cycles = locs[i]['mixes'][step]
+        for _ in range(reps):
+            for asp_loc, disp_loc, (asp_flow, disp_flow) in cycles:
+                m300.flow_rate.aspirate = asp_flow
+                m300.flow_rate.dispense = disp_flow
+                m300.aspirate(vol, asp_loc)
+                m300.dispense(vol, disp_loc)
+        m300.flow_rate.aspirate, m300.flow_rate.dispense = flow
+
+    def wash(plate, wash_vol, source, mix, park=True, key='wash'):
+        if not pending(key + '/remove', plate['cols']):
+            return
+        plate['magdeck'].disengage()
 
         num_trans = math.ceil(wash_vol/200)
         vol_per_trans = wash_vol/num_trans
         wash_vol_rem = wash_vol
-        for i, (m, spot) in enumerate(zip(mag_samples_m, parking_spots)):
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = -1 if side_ind % 2 == 0 else 1
-            pick_up(m300)
-            loc = m.bottom(LOCBOTTOM+0.5).move(Point(x=side*SIDEBOTTOM)) # mudei de LOCBOTTOM  3>2.5
-            src = source[i//(12//len(source))]
-            for n in range(num_trans):
-                if m300.current_volume > 0:
-                    m300.dispense(m300.current_volume, src.top())
-                m300.transfer(vol_per_trans, src.bottom(0.8), m.top(), air_gap=20,
-                              new_tip='never')
-                if n < num_trans - 1:  # only air_gap if going back to source
-                    m300.air_gap(20)
-            m300.mix(mix_reps, 150, loc)
-            m300.blow_out(m.top())
+        if MULTI_DISPENSE:
+            add_reagent(plate, wash_vol, source, key=key + '/add')
+        mix_cols = pending(key + '/mix', plate['cols'])
+        for j, i in enumerate(plate['cols']):
+            if i not in mix_cols:
+                continue
+            pick_up_for(m300, i)
+            if not MULTI_DISPENSE:
+                for n in range(num_trans):
+                    src = reagent(source, 8*vol_per_trans, locs[i]['top'])
+                    if m300.current_volume > 0:
+                        m300.dispense(m300.current_volume, src.top())
+                    m300.transfer(vol_per_trans, src.bottom(0.8), locs[i]['top'],
+                                  air_gap=20, new_tip='never')
+                    if n < num_trans - 1:  # only air_gap if going back to source
+                        m300.air_gap(20)
+            well_vol[i] += wash_vol
+            mix_profile(i, mix, 150)
+            m300.blow_out(locs[i]['top'])
             m300.air_gap(20)
             if park:
-                m300.drop_tip(spot)
+                park_tip(m300, i)
             else:
                 drop(m300)
+            mark(key + '/mix', i)
 
-        magdeck.engage(height=magheight)
-        ctx.delay(minutes=INCUBATION_TIME, msg='Incubating on MagDeck for 9 minutes.')
+        plate['magdeck'].engage(height=magheight)
+        minutes = settle_time('wash', plate)
+        yield minutes, 'Incubating on MagDeck for ' + \
+str(round(minutes, 1)) + ' minutes.'
 
-        remove_supernatant(wash_vol_rem+40, park=park) #+40
+        remove_supernatant(plate, wash_vol_rem+40, park=park,
+                           key=key + '/remove') #+40
 
-    def wash_etoh(wash_etoh_vol, source_etoh, mix_reps_etoh, park=True):
-        magdeck.disengage()
+    def wash_etoh(plate, wash_etoh_vol, source_etoh, mix_etoh, park=True,
+                  key='wash_etoh'):
+        if not pending(key + '/remove', plate['cols']):
+            return
+        plate['magdeck'].disengage()
 
         num_trans = math.ceil(wash_etoh_vol/200)
         vol_per_trans = wash_etoh_vol/num_trans
-        for i, (m, spot) in enumerate(zip(mag_samples_m, parking_spots)):
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = -1 if side_ind % 2 == 0 else 1
-            pick_up(m300)
-            loc = m.bottom(LOCBOTTOM +0.5).move(Point(x=side*SIDEBOTTOM)) # mudei de LOCBOTTOM - "valor"  3>2.5
-            src = source_etoh[i//(12//len(source_etoh))]
-            for n in range(num_trans):
-                if m300.current_volume > 0:
-                    m300.dispense(m300.current_volume, src.top())
-                m300.transfer(vol_per_trans, src.bottom(0.8), m.top(), air_gap=20,
-                              new_tip='never')
-                if n < num_trans - 1:  # only air_gap if going back to source_etoh
-                    m300.air_gap(20)
-            m300.mix(mix_reps_etoh, 150, loc)
-            m300.blow_out(m.top())
+        mix_cols = pending(key + '/mix', plate['cols'])
+        if MULTI_DISPENSE:
+            add_reagent(plate, wash_etoh_vol, source_etoh, key=key + '/add')
+        for j, i in enumerate(plate['cols']):
+            if i not in mix_cols:
+                continue
+            pick_up_for(m300, i)
+            if not MULTI_DISPENSE:
+                for n in range(num_trans):
+                    src = reagent(source_etoh, 8*vol_per_trans, locs[i]['top'])
+                    if m300.current_volume > 0:
+                        m300.dispense(m300.current_volume, src.top())
+                    m300.transfer(vol_per_trans, src.bottom(0.8), locs[i]['top'],
+                                  air_gap=20, new_tip='never')
+                    if n < num_trans - 1:  # only air_gap if going back to source_etoh
+                        m300.air_gap(20)
+            well_vol[i] += wash_etoh_vol
+            mix_profile(i, mix_etoh, 150)
+            m300.blow_out(locs[i]['top'])
             m300.air_gap(20)
             if park:
-                m300.drop_tip(spot)
+                park_tip(m300, i)
             else:
                 drop(m300)
+            mark(key + '/mix', i)
+
+        plate['magdeck'].engage(height=magheight)
+        minutes = settle_time('etoh', plate)
+        yield minutes, 'Incubating on MagDeck for ' + \
+str(round(minutes, 1)) + ' minutes.'
 
-        magdeck.engage(height=magheight)
-        ctx.delay(minutes=INCUBATION_TIME, msg='Incubating on MagDeck for 9 minutes.')
+        remove_supernatant(plate, wash_etoh_vol+40, park=park,
+                           key=key + '/remove') #+40
 
-        remove_supernatant(wash_etoh_vol+40, park=park) #+40
 
 
+    def stage_elution(plate, key='elute/stage'):
+        """
+        `stage_elution` fills the elution strip wells of the sample columns of
+        a plate, so that elute only has a short move to the buffer of each
+        column. Only the wells that were not filled yet are filled.
+        :param plate (dict): The plate to fill the elution strips for.
+        :param key (str): Checkpoint key of the step.
+        """
+        add_reagent(plate, elution_add, elution_res, dest='stage_top', key=key)
 
-    def elute(vol, park=True):
+    def elute(plate, vol, park=True, key='elute'):
+        if not pending(key + '/transfer', plate['cols']):
+            return
         # resuspend beads in elution
-        for m, spot in zip(mag_samples_m, parking_spots):
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = -1 if side_ind % 2 == 0 else 1
-            pick_up(m300)
-            loc = m.bottom(LOCBOTTOM).move(Point(x=side*SIDEBOTTOM)) # mudei de LOCBOTTOM  3>2.5
-            m300.aspirate(vol, elution_solution)
-            m300.move_to(m.center())
-            m300.dispense(vol, loc)
-            m300.mix(10, 0.8*vol, loc)
-            m300.blow_out(m.bottom(5))
+        cols = pending(key + '/resuspend', plate['cols'])
+        if ELUTION_MODE == 'strip':
+            stage_elution(plate, key=key + '/stage')
+        elif ELUTION_MODE == 'multi' and cols:
+            # every column is dry before the buffer is added to all of them,
+            # from the top of the wells, the shared tip never reaches the
+            # dried beads
+            if ADAPTIVE_DRY:
+                for i in cols:
+                    wait_dry(i)
+            add_reagent(plate, vol, elution_res, key=key + '/add')
+        for i in cols:
+            if ADAPTIVE_DRY and ELUTION_MODE != 'multi':
+                wait_dry(i)
+            pick_up_for(m300, i)
+            if ELUTION_MODE != 'multi':
+                if ELUTION_MODE == 'strip':
+                    m300.aspirate(vol, locs[i]['stage'])
+                else:
+                    m300.aspirate(vol, reagent(elution_res, 8*vol, locs[i]['top']))
+                m300.move_to(locs[i]['center'])
+                m300.dispense(vol, locs[i]['resuspend'])
+            well_vol[i] += vol
+            mix_profile(i, 'elution', 0.8*vol)
+            m300.blow_out(locs[i]['blow_out'])
             m300.air_gap(20)
             if park:
-                m300.drop_tip(spot)
+                park_tip(m300, i)
             else:
                 drop(m300)
+            mark(key + '/resuspend', i)
 
-        ctx.delay(minutes=INCUBATION_TIME, msg='Incubating off magnet at room temperature \
-for 9 minutes')  
-        magdeck.engage(height=magheight)
-        ctx.delay(minutes=INCUBATION_TIME, msg='Incubating on magnet at room temperature \
-for 9 minutes')  
+        yield INCUBATION_TIME, 'Incubating off magnet at room temperature \
+for 9 minutes'
+        plate['magdeck'].engage(height=magheight)
+        minutes = settle_time('elution', plate)
+        yield minutes, 'Incubating on magnet at room temperature for ' + \
+str(round(minutes, 1)) + ' minutes'
 
-        for m, e, spot in zip(mag_samples_m, elution_samples_m, parking_spots):
-            if park:
-                pick_up(m300, spot)
-            else:
-                pick_up(m300)
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = 1 if side_ind % 2 == 0 else -1
-            loc = m.bottom(LOCBOTTOM).move(Point(x=side*SIDEBOTTOM))  # mudei de LOCBOTTOM  3>2.5
-            m300.transfer(40, loc, e.bottom(5), air_gap=20, new_tip='never')
-            m300.blow_out(e.top(-2))
+        for i in pending(key + '/transfer', plate['cols']):
+            pick_up_for(m300, i, park)
+            m300.transfer(40, locs[i]['eluate'], locs[i]['elution_dispense'],
+                          air_gap=20, new_tip='never')
+            well_vol[i] = max(well_vol[i] - 40, 0)
+            m300.blow_out(locs[i]['elution_blow_out'])
             m300.air_gap(20)
-            m300.drop_tip()
+            drop(m300)
+            mark(key + '/transfer', i)
 
-    magdeck.engage(height=magheight)
-    ctx.delay(minutes=INCUBATION_TIME, msg='Incubating on MagDeck for 9 minutes.')
+    def process(plate):
+        """
+        `process` is the extraction of one plate, from the lysate on the
+        magnet to the eluate. It yields at every incubation, see `run_plates`.
+        :param plate (dict): The plate to extract.
+        """
+        # steps and columns done in a resumed run are skipped
+        key = plate['name'] + '/'
+        if pending(key + 'lysate/remove', plate['cols']):
+            plate['magdeck'].engage(height=magheight)
+            minutes = settle_time('lysate', plate)
+            yield minutes, 'Incubating on MagDeck for ' + \
+str(round(minutes, 1)) + ' minutes.'
 
-    # remove initial supernatant
+            # remove initial supernatant
 
-    m300.flow_rate.aspirate = 50
-    remove_supernatant(STARTING_VOL, park=PARK)
-    wash(WASH_VOL, wash1, 15, park=PARK)
-    wash_etoh(WASH_VOL, etoh, 15, park=PARK)
-    wash_etoh(WASH_VOL, etoh, 15, park=PARK)
-
-    magdeck.disengage()
-    ctx.delay(minutes=DRY_TIME, msg='Airdrying beads at room temperature for 5 \
-minutes.')
-    m300.flow_rate.aspirate = 50
-    elute(ELUTION_VOL, park=PARK)
+            m300.flow_rate.aspirate = 50
+            remove_supernatant(plate, STARTING_VOL, park=PARK,
+                               key=key + 'lysate/remove')
+        for n, (step, vol, source) in enumerate(wash_steps):
+            yield from step(plate, vol, plate[source], source, park=PARK,
+                            key=key + 'wash ' + str(n+1))
+
+        if not pending(key + 'elute/resuspend', plate['cols']):
+            yield from elute(plate, ELUTION_VOL, park=PARK, key=key + 'elute')
+            return
+        plate['magdeck'].disengage()
+        if ADAPTIVE_DRY:
+            # only until the first column is dry, elute waits for the others
+            ctx.comment('Air dry of ' + ', '.join(
+                str(round(dry_time(i), 1)) for i in plate['cols']) + \
+' minutes per column.')
+            minutes = max(min(last_removal['time'][i] + dry_time(i)*60
+                              for i in plate['cols']) - clock(), 0)/60
+        else:
+            minutes = DRY_TIME
+        yield minutes, 'Airdrying beads at room temperature for ' + \
+str(round(minutes, 1)) + ' minutes.'
+        m300.flow_rate.aspirate = 50
+        yield from elute(plate, ELUTION_VOL, park=PARK, key=key + 'elute')
+
+    # wash steps of WASHES, the liquid is also the plate source
+    wash_steps = [(wash if liquid == 'wash' else wash_etoh, vol, liquid)
+                  for liquid, vol in WASHES]
+
+    if RESUME and not ctx.is_simulating() and os.path.isfile(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        if saved['config'] != checkpoint['config']:
+            raise Exception('The checkpoint in ' + checkpoint_path + ' is \
+from a run with other settings (' + str(saved['config']) + ').')
+        checkpoint['done'] = saved['done']
+        state = saved['state']
+        tip_log['count'][m300] = state['tips']
+        park_log['parked'] = state['parked']
+        park_log['uses'] = state['uses']
+        drop_count = state['drops']
+        tip_log['returned'][m300] = state['returned']
+        switch = state['switch']
+        waste_vols[:] = state['waste']
+        well_vol[:] = state['well_vol']
+        last_removal['height'] = state['height']
+        last_removal['trips'] = state['trips']
+        # the clock of the cancelled run is lost, the air dry of every
+        # column starts again
+        last_removal['time'] = [clock() for _ in mag_samples_m]
+        for res, vols in zip(reservoirs, state['reagents']):
+            res.vols = vols
+        ctx.comment('Resuming the run from ' + checkpoint_path + ', ' + \
+str(sum(len(cols) for cols in saved['done'].values())) + ' column steps are \
+already done.')
+
+    # plan all operator interventions before starting, the windows of the
+    # plates alternate as in run_plates
+    usage = [plan_usage(len(plate['cols']),
+                        ' of ' + plate['name'] if len(plates) > 1 else '')
+             for plate in plates]
+    segments = [{r: sum(plate_segments[0][r] for plate_segments, _ in usage)
+                 for r in usage[0][0][0]}]
+    windows = []
+    for w in range(len(usage[0][1])):
+        for plate_segments, plate_windows in usage:
+            segments.append(plate_segments[w+1])
+            windows.append(plate_windows[w])
+    plan, unplanned = plan_interventions(
+        segments,
+        {'tips': tip_log['count'][m300], 'drops': drop_count,
+         'waste': sum(waste_vols), 'etoh': etoh_res.drawn()},
+        {'tips': tip_log['max'][m300] + 1, 'drops': drop_threshold,
+         'waste': waste_threshold, 'etoh': etoh_res.usable() + 1},
+        rack_cols if RETURN_TIPS else None)
+    if checkpoint['done']:
+        # the skipped steps shift the windows, the pauses stay unplanned
+        ctx.comment('Operator interventions are not planned in a resumed run.')
+    else:
+        interventions.update(plan)
+        ctx.comment('Operator intervention plan:')
+        for n, w in enumerate(sorted(plan)):
+            ctx.comment('Pause ' + str(n+1) + ' during ' + windows[w] + ': ' + \
+', '.join(intervention_msgs[r] for r in plan[w]) + '.')
+        if not plan:
+            ctx.comment('No pauses needed.')
+        for n in unplanned:
+            ctx.comment('An unplanned pause cannot be avoided after ' + \
+(windows[n-1] if n > 0 else 'the start of the run') + '.')
+
+    run_plates([(plate, process(plate)) for plate in plates])
+
+    # the run is complete, a next run starts from scratch
+    if not ctx.is_simulating() and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    notifier.stop()
@@ -22,6 +22,103 @@ ICPK_VOlUME = 15
 TIP_TRACK = False
 #Não mexer
 
+# volume (µl) left in each well of a reagent reservoir that the pipette
+# cannot aspirate
+RESERVOIR_DEAD_VOL = {'nest_12_reservoir_15ml': 1500,
+                      'nest_1_reservoir_195ml': 10000}
+
+# working volume (µl) a reagent reservoir well is filled to at most, below
+# the nominal volume so the well can be carried and pipetted without
+# spilling
+RESERVOIR_MAX_FILL = {'nest_12_reservoir_15ml': 13000,
+                      'nest_1_reservoir_195ml': 185000}
+
+
+class Reservoir:
+    """
+    `Reservoir` keeps the volume of every well of a reagent reservoir. Every
+    aspiration is drawn from the nearest well to its destination that still
+    has the volume above the dead volume, and `plan` gives the fill table for
+    the run.
+    :param name (str): Name of the reagent, for the fill table and pauses.
+    :param wells (List[Well]): The wells holding the reagent.
+    :param dead_vol (float): Volume (µl) that cannot be aspirated from a well.
+    :param max_trip (float): Largest volume (µl) drawn at once, the wells are
+                             filled with that margin.
+    :param max_fill (float): Working volume (µl) a well is filled to at most.
+    """
+
+    def __init__(self, name, wells, dead_vol, max_trip, max_fill):
+        self.name = name
+        self.wells = wells
+        self.dead_vol = dead_vol
+        self.max_trip = max_trip
+        self.max_fill = max_fill
+        self.fill = [0 for _ in wells]
+        self.vols = [0 for _ in wells]
+        self.short = 0  # demand (µl) the fill table does not cover
+
+    def nearest(self, loc):
+        """
+        `nearest` sorts the wells by their distance to a location.
+        :param loc (Location): The destination.
+        :return: The indices of the wells, nearest first.
+        """
+        return sorted(range(len(self.wells)), key=lambda w: math.hypot(
+            self.wells[w].top().point.x - loc.point.x,
+            self.wells[w].top().point.y - loc.point.y))
+
+    def plan(self, demand, loc):
+        """
+        `plan` adds a demand to the fill table. The nearest wells to the
+        destination are filled first, as they are drawn from first. Each well
+        in use keeps its dead volume and one trip of margin, which is the most
+        that can be left in it when a trip does not fit anymore.
+        :param demand (float): Volume (µl) that will be drawn.
+        :param loc (Location): Where the volume goes.
+        """
+        for w in self.nearest(loc):
+            if demand <= 0:
+                break
+            if self.fill[w] == 0:
+                self.fill[w] = self.dead_vol + self.max_trip
+            take = min(demand, self.max_fill - self.fill[w])
+            self.fill[w] += max(take, 0)
+            demand -= max(take, 0)
+        self.short += max(demand, 0)
+        self.vols = list(self.fill)
+
+    def draw(self, vol, loc):
+        """
+        `draw` takes a volume from the nearest well that has it.
+        :param vol (float): Volume (µl) of the aspiration, all channels.
+        :param loc (Location): Where the volume goes.
+        :return: The well to aspirate from, or None when no well has it.
+        """
+        for w in self.nearest(loc):
+            if self.vols[w] - vol >= self.dead_vol:
+                self.vols[w] -= vol
+                return self.wells[w]
+        return None
+
+    def refill(self):
+        self.vols = list(self.fill)
+
+    def drawn(self):
+        """
+        `drawn` gives the volume (µl) drawn since the reservoir was filled.
+        """
+        return sum(self.fill) - sum(self.vols)
+
+    def usable(self):
+        """
+        `usable` gives the volume (µl) that can surely be drawn from a full
+        reservoir, every well in use keeps its dead volume and up to one trip.
+        """
+        return sum(vol - self.dead_vol - self.max_trip
+                   for vol in self.fill if vol > 0)
+
+
 def run(ctx: protocol_api.ProtocolContext):
 
     # load labware
@@ -134,10 +231,50 @@ resuming.')
     num_trans = math.ceil(BB_VOLUME/210)
     vol_per_trans = BB_VOLUME/num_trans
     vol_out = vol_per_trans
-    for i, m in enumerate(dests_multi):
-        source = binding_buffer.wells()[i//4]
+    bb_res = Reservoir('binding buffer', binding_buffer.wells(),
+                       RESERVOIR_DEAD_VOL['nest_12_reservoir_15ml'],
+                       8*vol_per_trans,
+                       RESERVOIR_MAX_FILL['nest_12_reservoir_15ml'])
+    bb_res.plan(8*BB_VOLUME*num_cols, dests_multi[0].top())
+    ctx.comment('Binding buffer fill table: ' + ', '.join(
+        str(round(vol)) + 'µl in ' + well.display_name
+        for well, vol in zip(bb_res.wells, bb_res.fill) if vol > 0) + '.')
+    if bb_res.short > 0:
+        ctx.comment(str(round(bb_res.short)) + 'µl more ' + bb_res.name + ' \
+than the wells hold are needed, the run will pause for a refill.')
+
+    def operator_pause(msg):
+        """
+        `operator_pause` pauses the run for the operator, with the pipette
+        homed out of the way.
+        :param msg (str): Message shown to the operator.
+        """
+        m300.home()
+        ctx.pause(msg)
+        ctx.home()  # home before continuing with protocol
+
+    def reagent(res, vol, loc):
+        """
+        `reagent` picks the reservoir well of an aspiration, see `Reservoir`.
+        The run is paused for a refill if no well has the volume left.
+        :param res (Reservoir): The reagent.
+        :param vol (float): Volume of the aspiration (all 8 channels).
+        :param loc (Location): Where the volume goes.
+        :return: The well to aspirate from.
+        """
+        well = res.draw(vol, loc)
+        if well is None:
+            # unplanned, the fill table covers the whole run
+            operator_pause('Please refill ' + res.name + ' as in the fill \
+table before resuming.')
+            res.refill()
+            well = res.draw(vol, loc)
+        return well
+
+    for m in dests_multi:
         pick_up(m300)
         for i in range(num_trans):
+            source = reagent(bb_res, 8*vol_per_trans, m.top())
             if i == 0:
                 m300.mix(MIX_REPETITIONS, MIX_VOLUME, source)
             ctx.delay(seconds=2)
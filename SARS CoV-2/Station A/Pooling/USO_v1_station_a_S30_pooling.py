@@ -12,10 +12,45 @@ metadata = {
 }
 
 NUM_SAMPLES = 11
-SAMPLE_VOLUME = 242.5
+POOL_VOLUME = 485  # split evenly between the samples of each pool
+POOL_SIZE = 2  # samples per pool, same as in the POOL mode of Stations B and C
+POOL_COLUMN = 8  # column index of the first pool (8 is column 9), None for right after the samples
 TIP_TRACK = False
 
 
+def pool_layout(num_samples, pool_size, first_pool_col=8, rows=8, cols=12):
+    """
+    `pool_layout` describes a pooled sample plate, the same description is
+    used by the Station A pooling protocol and the POOL mode of Stations B and
+    C. The samples fill the plate column by column from A1 and are pooled in
+    order, pool_size at a time, into the wells from the top of first_pool_col.
+    When the samples do not divide evenly the last pool is smaller.
+    :param num_samples (int): Number of samples on the plate.
+    :param pool_size (int): Number of samples per pool (2, 4, 8...).
+    :param first_pool_col (int): Index of the first column of pools, None to
+                                 start the pools after the sample columns.
+    :param rows (int): Number of rows of the plate.
+    :param cols (int): Number of columns of the plate.
+    :return: The pools as (pool well index, sample well indices), and the
+             indices of the columns that hold samples or pools.
+    """
+    if pool_size < 2:
+        raise Exception('POOL_SIZE must be at least 2.')
+    num_cols = math.ceil(num_samples/rows)
+    if first_pool_col is None:
+        first_pool_col = num_cols
+    pools = [(first_pool_col*rows + n,
+              list(range(s, min(s + pool_size, num_samples))))
+             for n, s in enumerate(range(0, num_samples, pool_size))]
+    pool_cols = math.ceil(len(pools)/rows)
+    if num_cols > first_pool_col or first_pool_col + pool_cols > cols:
+        raise Exception(str(num_samples) + ' samples in pools of ' + \
+str(pool_size) + ' do not fit in the plate with the pools from column ' + \
+str(first_pool_col + 1) + '.')
+    return pools, list(range(num_cols)) + \
+        list(range(first_pool_col, first_pool_col + pool_cols))
+
+
 def run(ctx: protocol_api.ProtocolContext):
 
     # load labware
@@ -61,16 +96,15 @@ resuming.')
         tip_log['count'][pip] += 1
 
     # pool samples
-    for i in range(math.ceil(NUM_SAMPLES/2)):
-        if NUM_SAMPLES % 2 != 0 and i == math.ceil(NUM_SAMPLES/2) - 1:
-            pool_source_set = [dest_plate.wells()[NUM_SAMPLES]]
-            vol = SAMPLE_VOLUME*2
-        else:
-            pool_source_set = dest_plate.wells()[i*2:i*2+2]
-            vol = SAMPLE_VOLUME
-        for s in pool_source_set:
+    pools, _ = pool_layout(NUM_SAMPLES, POOL_SIZE, POOL_COLUMN,
+                           len(dest_plate.columns()[0]),
+                           len(dest_plate.columns()))
+    for pool_well, sample_wells in pools:
+        vol = POOL_VOLUME/len(sample_wells)
+        for s in sample_wells:
             pick_up(p1000)
-            p1000.transfer(vol, s, dest_plate.wells()[i+64],
+            p1000.transfer(vol, dest_plate.wells()[s],
+                           dest_plate.wells()[pool_well],
                            mix_before=(1, 200), air_gap=20, new_tip='never')
             p1000.air_gap(10)
             p1000.drop_tip()
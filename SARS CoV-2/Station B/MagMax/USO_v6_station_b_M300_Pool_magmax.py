@@ -2,8 +2,9 @@ from opentrons.types import Point
 import json
 import os
 import math
+import socket
 import threading
-from time import sleep
+from time import monotonic, strftime
 
 metadata = {
     'protocolName': 'USO_v6_station_b_M300_Pool_magmax',
@@ -16,38 +17,141 @@ ELUTION_VOL = 50
 STARTING_VOL = 600
 WASH_VOL = 500
 POOL = True
+POOL_SIZE = 2  # samples per pool, as in the Station A pooling protocol
+POOL_COLUMN = 8  # column index of the first pool (8 is column 9), None for right after the samples
 TIP_TRACK = False
 PARK = True
+CONSOLIDATE_TRIPS = True  # supernatant trips go to the nearest point of the waste and only the last one blows out
+FLASH = True  # flash the deck lights while the run is paused for the operator
+FLASH_PATTERN = [(True, 1), (False, 1)]  # (rail lights on, seconds) steps
+ALERT_ADDRESS = None  # ('<ip>', 5005) to send alerts to UTIL Opentrons APP/alert_listener.py
+
+# length (mm) along x of the reservoir wells used as liquid waste
+RESERVOIR_WELL_LENGTH = {'nest_1_reservoir_195ml': 106.8,
+                         'nest_12_reservoir_15ml': 8.2}
+
+# Definitions for deck light flashing and operator alerts
+class NotificationService:
+    """
+    `NotificationService` flashes the deck lights and records an alert event
+    while the run is paused for the operator. A single long-lived worker
+    thread waits on a `threading.Event`, so nothing runs between pauses.
+    :param hardware: The robot hardware, or None to not flash the lights.
+    :param pattern (List[tuple]): Flash pattern as (rail lights on, seconds)
+                                  steps, repeated while the alert lasts.
+    :param log_path (str): File the alert events are appended to, or None.
+    :param address (tuple): (host, port) the alert events are sent to over
+                            UDP, or None.
+    """
+
+    def __init__(self, hardware, pattern, log_path=None, address=None):
+        self._hardware = hardware
+        self._pattern = pattern
+        self._log_path = log_path
+        self._address = address
+        self._alert = threading.Event()
+        self._quiet = threading.Event()
+        self._quiet.set()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._flash, daemon=True)
+        self._worker.start()
+
+    def _flash(self):
+        while True:
+            self._alert.wait()
+            if self._stopped:
+                return
+            while self._alert.is_set() and not self._stopped:
+                for rails, seconds in self._pattern:
+                    if self._hardware:
+                        self._hardware.set_lights(rails=rails)
+                    if self._quiet.wait(seconds):
+                        break
+            if self._hardware:
+                self._hardware.set_lights(rails=False)
+
+    def _record(self, event, msg):
+        # alerts are best effort, they must never stop the run
+        line = json.dumps({'time': strftime('%Y-%m-%d %H:%M:%S'),
+                           'event': event, 'msg': msg})
+        try:
+            if self._log_path:
+                with open(self._log_path, 'a') as log_file:
+                    log_file.write(line + '\n')
+            if self._address:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.sendto(line.encode('utf-8'), self._address)
+                sock.close()
+        except OSError:
+            pass
+
+    def alert(self, msg):
+        self._record('pause', msg)
+        self._quiet.clear()
+        self._alert.set()
+
+    def clear(self):
+        self._alert.clear()
+        self._quiet.set()
+        self._record('resume', '')
+
+    def stop(self):
+        self._stopped = True
+        self._quiet.set()
+        self._alert.set()
+        self._worker.join()
+
+
+def pool_layout(num_samples, pool_size, first_pool_col=8, rows=8, cols=12):
+    """
+    `pool_layout` describes a pooled sample plate, the same description is
+    used by the Station A pooling protocol and the POOL mode of Stations B and
+    C. The samples fill the plate column by column from A1 and are pooled in
+    order, pool_size at a time, into the wells from the top of first_pool_col.
+    When the samples do not divide evenly the last pool is smaller.
+    :param num_samples (int): Number of samples on the plate.
+    :param pool_size (int): Number of samples per pool (2, 4, 8...).
+    :param first_pool_col (int): Index of the first column of pools, None to
+                                 start the pools after the sample columns.
+    :param rows (int): Number of rows of the plate.
+    :param cols (int): Number of columns of the plate.
+    :return: The pools as (pool well index, sample well indices), and the
+             indices of the columns that hold samples or pools.
+    """
+    if pool_size < 2:
+        raise Exception('POOL_SIZE must be at least 2.')
+    num_cols = math.ceil(num_samples/rows)
+    if first_pool_col is None:
+        first_pool_col = num_cols
+    pools = [(first_pool_col*rows + n,
+              list(range(s, min(s + pool_size, num_samples))))
+             for n, s in enumerate(range(0, num_samples, pool_size))]
+    pool_cols = math.ceil(len(pools)/rows)
+    if num_cols > first_pool_col or first_pool_col + pool_cols > cols:
+        raise Exception(str(num_samples) + ' samples in pools of ' + \
+str(pool_size) + ' do not fit in the plate with the pools from column ' + \
+str(first_pool_col + 1) + '.')
+    return pools, list(range(num_cols)) + \
+        list(range(first_pool_col, first_pool_col + pool_cols))
+
+
+def nearest_dispense(top, length, loc, margin=5):
+    """
+    `nearest_dispense` gives the point at the top of a reservoir well, along
+    its length, that is nearest to a location. The 8 channels of the pipette
+    span the width of the well, so only x can move.
+    :param top (Location): Top center of the reservoir well.
+    :param length (float): Length (mm) of the well along x.
+    :param loc (Location): The location the pipette comes from.
+    :param margin (float): Distance (mm) kept from the ends of the well.
+    :return: The location to dispense at.
+    """
+    reach = max(length/2 - margin, 0)
+    return top.move(Point(x=min(max(loc.point.x - top.point.x, -reach), reach)))
 
-# Definitions for deck light flashing
-class CancellationToken:
-    def __init__(self):
-       self.is_continued = False
-
-    def set_true(self):
-       self.is_continued = True
-
-    def set_false(self):
-       self.is_continued = False
-
-
-def turn_on_blinking_notification(hardware, pause):
-    while pause.is_continued:
-        hardware.set_lights(rails=True)
-        sleep(1)
-        hardware.set_lights(rails=False)
-        sleep(1)
-
-def create_thread(ctx, cancel_token):
-    t1 = threading.Thread(target=turn_on_blinking_notification, args=(ctx._hw_manager.hardware, cancel_token))
-    t1.start()
-    return t1
 
 # Start protocol
 def run(ctx):
-    # Setup for flashing lights notification to empty trash
-    # cancellationToken = CancellationToken()
-
     # load labware and pipettes
     num_cols = math.ceil(NUM_SAMPLES/8)
     tips300 = [ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filtertiprack')
@@ -73,6 +177,10 @@ def run(ctx):
     magplate = magdeck.load_labware('nest_96_wellplate_2ml_deep')
     # magplate = magdeck.load_labware('biorad_96_wellplate_200ul_pcr')
     tempdeck = ctx.load_module('Temperature Module Gen2', '1')
+    # start cooling the elution block now, the run only waits for it before
+    # the eluate is transferred
+    temp_ramp = {'celsius': 4, 'start': monotonic(), 'done': False}
+    tempdeck.start_set_temperature(temp_ramp['celsius'])
     flatplate = tempdeck.load_labware(
                 'opentrons_96_aluminumblock_nest_wellplate_100ul',)
     waste = ctx.load_labware('nest_1_reservoir_195ml', '11',
@@ -85,14 +193,35 @@ def run(ctx):
     elution_solution = res1.wells()[-1]
 
     if POOL:
-        mag_samples_m = magplate.rows()[0][:num_cols] + magplate.rows()[0][8:8+math.ceil(num_cols/2)]
-        elution_samples_m = flatplate.rows()[0][:num_cols] + flatplate.rows()[0][8:8+math.ceil(num_cols/2)]
+        sample_cols = pool_layout(NUM_SAMPLES, POOL_SIZE, POOL_COLUMN)[1]
     else:
-        mag_samples_m = magplate.rows()[0][:num_cols]
-        elution_samples_m = flatplate.rows()[0][:num_cols]
+        sample_cols = list(range(num_cols))
+    mag_samples_m = [magplate.rows()[0][c] for c in sample_cols]
+    elution_samples_m = [flatplate.rows()[0][c] for c in sample_cols]
+
+    # location cache: every location used on a sample column is computed once
+    # here. Supernatant is aspirated away from the bead pellet and the mixes
+    # are dispensed against it.
+    locs = []
+    for c, m, e in zip(sample_cols, mag_samples_m, elution_samples_m):
+        side = 1 if (c+1) % 2 == 0 else -1
+        locs.append({
+            'top': m.top(),
+            'center': m.center(),
+            'supernatant': m.bottom(0.8).move(Point(x=side*2.5)),
+            'mix': m.bottom(0.8).move(Point(x=-side*2.5)),
+            'etoh_mix': m.bottom(0.5).move(Point(x=-side*2.5)),
+            'blow_out': m.bottom(5),
+            'elution_dispense': e.bottom(5),
+            'elution_blow_out': e.top(-2),
+            'waste': nearest_dispense(
+                waste, RESERVOIR_WELL_LENGTH['nest_1_reservoir_195ml'],
+                m.top()) if CONSOLIDATE_TRIPS else waste
+        })
+    trash = ctx.loaded_labwares[12].wells()[0].top()
+    drop_locs = [trash.move(Point(x=30)), trash.move(Point(x=-18))]
 
     magdeck.disengage()  # just in case
-    tempdeck.set_temperature(4)
 
     m300.flow_rate.aspirate = 50
     m300.flow_rate.dispense = 150
@@ -100,6 +229,53 @@ def run(ctx):
 
     folder_path = '/data/B'
     tip_file_path = folder_path + '/tip_log.json'
+    if not ctx.is_simulating() and not os.path.isdir(folder_path):
+        os.mkdir(folder_path)
+
+    # deck lights and alerts while the run is paused for the operator
+    notifier = NotificationService(
+        ctx._hw_manager.hardware if FLASH and not ctx.is_simulating() else None,
+        FLASH_PATTERN,
+        log_path=None if ctx.is_simulating() else folder_path + '/alerts.log',
+        address=None if ctx.is_simulating() else ALERT_ADDRESS)
+
+    def operator_pause(msg):
+        """
+        `operator_pause` pauses the run for the operator. The deck lights
+        flash and an alert is recorded until the run is resumed.
+        :param msg (str): Message shown to the operator.
+        """
+        notifier.alert(msg)
+        m300.home()
+        ctx.pause(msg)
+        ctx.home()  # home before continuing with protocol
+        notifier.clear()
+
+    def await_temperature():
+        """
+        `await_temperature` waits for the temperature module to reach the
+        temperature started when it was loaded. The ramp time (an upper bound
+        when the block was already cold) and the time the run had to wait are
+        commented and appended to /data/B/temperature_log.json.
+        """
+        if temp_ramp['done']:
+            return
+        waited = monotonic()
+        tempdeck.await_temperature(temp_ramp['celsius'])
+        end = monotonic()
+        temp_ramp['done'] = True
+        ramp = (end - temp_ramp['start'])/60
+        wait = (end - waited)/60
+        ctx.comment('Temperature module at ' + str(temp_ramp['celsius']) + \
+'°C after ' + str(round(ramp, 1)) + ' minutes (waited ' + str(round(wait, 1)) + \
+' minutes).')
+        if not ctx.is_simulating():
+            with open(folder_path + '/temperature_log.json', 'a') as temp_file:
+                temp_file.write(json.dumps({
+                    'time': strftime('%Y-%m-%d %H:%M:%S'),
+                    'celsius': temp_ramp['celsius'], 'ramp_minutes': ramp,
+                    'waited_minutes': wait}) + '\n')
+
     tip_log = {'count': {}}
     if TIP_TRACK and not ctx.is_simulating():
         if os.path.isfile(tip_file_path):
@@ -121,8 +297,8 @@ def run(ctx):
     def pick_up(pip, loc=None):
         nonlocal tip_log
         if tip_log['count'][pip] == tip_log['max'][pip] and not loc:
-            ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-resuming.')
+            operator_pause('Replace ' + str(pip.max_volume) + 'µl tipracks \
+before resuming.')
             pip.reset_tipracks()
             tip_log['count'][pip] = 0
         if loc:
@@ -138,23 +314,11 @@ resuming.')
     def drop(pip):
         nonlocal switch
         nonlocal drop_count
-        side = 30 if switch else -18
-        drop_loc = ctx.loaded_labwares[12].wells()[0].top().move(
-            Point(x=side))
-        pip.drop_tip(drop_loc)
+        pip.drop_tip(drop_locs[0] if switch else drop_locs[1])
         switch = not switch
         drop_count += 8
         if drop_count == drop_threshold:
-            # Setup for flashing lights notification to empty trash
-            # if not ctx._hw_manager.hardware.is_simulator:
-            #     cancellationToken.set_true()
-            # thread = create_thread(ctx, cancellationToken)
-            m300.home()
-            ctx.pause('Please empty tips from waste before resuming.')
-
-            ctx.home()  # home before continuing with protocol
-            # cancellationToken.set_false()  # stop light flashing after home
-            # thread.join()
+            operator_pause('Please empty tips from waste before resuming.')
             drop_count = 0
 
     waste_vol = 0
@@ -165,39 +329,36 @@ resuming.')
         def waste_track(vol):
             nonlocal waste_vol
             if waste_vol + vol >= waste_threshold:
-                # Setup for flashing lights notification to empty liquid waste
-                # if not ctx._hw_manager.hardware.is_simulator:
-                #     cancellationToken.set_true()
-                # thread = create_thread(ctx, cancellationToken)
-                m300.home()
-                ctx.pause('Please empty liquid waste (slot 11) before resuming.')
-
-                ctx.home()  # home before continuing with protocol
-                # cancellationToken.set_false() # stop light flashing after home
-                # thread.join()
+                operator_pause('Please empty liquid waste (slot 11) before \
+resuming.')
                 waste_vol = 0
             waste_vol += vol
 
         m300.flow_rate.aspirate = 30
         num_trans = math.ceil(vol/200)
         vol_per_trans = vol/num_trans
-        for m, spot in zip(mag_samples_m, parking_spots):
+        for loc, spot in zip(locs, parking_spots):
             if park:
                 pick_up(m300, spot)
             else:
                 pick_up(m300)
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = 1 if side_ind % 2 == 0 else -1
-            loc = m.bottom(0.8).move(Point(x=side*2.5)) # mudei de 0.5>0.8  3>2.5
-            for _ in range(num_trans):
+            for t in range(num_trans):
                 waste_track(vol_per_trans)
                 if m300.current_volume > 0:
-                    m300.dispense(m300.current_volume, m.top())  # void air gap if necessary
-                m300.move_to(m.center())
-                m300.transfer(vol_per_trans, loc, waste, new_tip='never',
-                              air_gap=10)
-                m300.blow_out(waste)
-                m300.air_gap(10)
+                    # void air gap, on the way down when trips are consolidated
+                    m300.dispense(m300.current_volume,
+                                  loc['center'] if CONSOLIDATE_TRIPS else loc['top'])
+                m300.move_to(loc['center'])
+                m300.transfer(vol_per_trans, loc['supernatant'], loc['waste'],
+                              new_tip='never', air_gap=10)
+                if not CONSOLIDATE_TRIPS or t == num_trans - 1:
+                    m300.blow_out(loc['waste'])
+                if CONSOLIDATE_TRIPS:
+                    # air gap where the trip was dispensed, air_gap() would
+                    # go back to the center of the waste
+                    m300.aspirate(10, loc['waste'].move(Point(z=5)))
+                else:
+                    m300.air_gap(10)
             drop(m300)
         m300.flow_rate.aspirate = 50  # mudei de 150
 
@@ -241,21 +402,18 @@ resuming.')
         num_trans = math.ceil(wash_vol/200)
         vol_per_trans = wash_vol/num_trans
         wash_vol_rem = wash_vol
-        for i, (m, spot) in enumerate(zip(mag_samples_m, parking_spots)):
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = -1 if side_ind % 2 == 0 else 1
+        for i, (loc, spot) in enumerate(zip(locs, parking_spots)):
             pick_up(m300)
-            loc = m.bottom(0.8).move(Point(x=side*2.5)) # mudei de 0.5>0.8  3>2.5
             src = source[i//(12//len(source))]
             for n in range(num_trans):
                 if m300.current_volume > 0:
                     m300.dispense(m300.current_volume, src.top())
-                m300.transfer(vol_per_trans, src.bottom(0.8), m.top(), air_gap=20,
+                m300.transfer(vol_per_trans, src.bottom(0.8), loc['top'], air_gap=20,
                               new_tip='never')
                 if n < num_trans - 1:  # only air_gap if going back to source
                     m300.air_gap(20)
-            m300.mix(mix_reps, 150, loc)
-            m300.blow_out(m.top())
+            m300.mix(mix_reps, 150, loc['mix'])
+            m300.blow_out(loc['top'])
             m300.air_gap(20)
             if park:
                 m300.drop_tip(spot)
@@ -272,21 +430,18 @@ resuming.')
 
         num_trans = math.ceil(wash_etoh_vol/200)
         vol_per_trans = wash_etoh_vol/num_trans
-        for i, (m, spot) in enumerate(zip(mag_samples_m, parking_spots)):
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = -1 if side_ind % 2 == 0 else 1
+        for i, (loc, spot) in enumerate(zip(locs, parking_spots)):
             pick_up(m300)
-            loc = m.bottom(0.5).move(Point(x=side*2.5)) # mudei de 0.5  3>2.5
             src = source_etoh[i//(12//len(source_etoh))]
             for n in range(num_trans):
                 if m300.current_volume > 0:
                     m300.dispense(m300.current_volume, src.top())
-                m300.transfer(vol_per_trans, src.bottom(0.8), m.top(), air_gap=20,
+                m300.transfer(vol_per_trans, src.bottom(0.8), loc['top'], air_gap=20,
                               new_tip='never')
                 if n < num_trans - 1:  # only air_gap if going back to source_etoh
                     m300.air_gap(20)
-            m300.mix(mix_reps_etoh, 150, loc)
-            m300.blow_out(m.top())
+            m300.mix(mix_reps_etoh, 150, loc['etoh_mix'])
+            m300.blow_out(loc['top'])
             m300.air_gap(20)
             if park:
                 m300.drop_tip(spot)
@@ -302,16 +457,13 @@ resuming.')
 
     def elute(vol, park=True):
         # resuspend beads in elution
-        for m, spot in zip(mag_samples_m, parking_spots):
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = -1 if side_ind % 2 == 0 else 1
+        for loc, spot in zip(locs, parking_spots):
             pick_up(m300)
-            loc = m.bottom(0.8).move(Point(x=side*2.5)) # mudei de 0.5>0.8  3>2.5
             m300.aspirate(vol, elution_solution)
-            m300.move_to(m.center())
-            m300.dispense(vol, loc)
-            m300.mix(10, 0.8*vol, loc)
-            m300.blow_out(m.bottom(5))
+            m300.move_to(loc['center'])
+            m300.dispense(vol, loc['mix'])
+            m300.mix(10, 0.8*vol, loc['mix'])
+            m300.blow_out(loc['blow_out'])
             m300.air_gap(20)
             if park:
                 m300.drop_tip(spot)
@@ -324,16 +476,15 @@ for 2 minutes')
         ctx.delay(minutes=2, msg='Incubating on magnet at room temperature \
 for 2 minutes')
 
-        for m, e, spot in zip(mag_samples_m, elution_samples_m, parking_spots):
+        await_temperature()
+        for loc, spot in zip(locs, parking_spots):
             if park:
                 pick_up(m300, spot)
             else:
                 pick_up(m300)
-            side_ind = int(m.display_name.split(' ')[0][1:])
-            side = 1 if side_ind % 2 == 0 else -1
-            loc = m.bottom(0.8).move(Point(x=side*2.5))  # mudei de 0.5>0.8  3>2.5
-            m300.transfer(40, loc, e.bottom(5), air_gap=20, new_tip='never')
-            m300.blow_out(e.top(-2))
+            m300.transfer(40, loc['supernatant'], loc['elution_dispense'],
+                          air_gap=20, new_tip='never')
+            m300.blow_out(loc['elution_blow_out'])
             m300.air_gap(20)
             m300.drop_tip()
 
@@ -354,3 +505,5 @@ for 2 minutes')
 minutes.')
     m300.flow_rate.aspirate = 50
     elute(ELUTION_VOL, park=PARK)
+
+    notifier.stop()
@@ -0,0 +1,20 @@
+# Stand-in listener for the operator alerts sent by the Station B protocols.
+#
+# Run it on a computer in the same network as the OT-2 and set
+# ALERT_ADDRESS = ('<ip of this computer>', 5005) in the protocol. Every
+# pause and resume of the run is printed as it arrives.
+
+import json
+import socket
+
+PORT = 5005
+
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.bind(('', PORT))
+print('Listening for OT-2 alerts on port ' + str(PORT))
+
+while True:
+    data, (host, _) = sock.recvfrom(4096)
+    event = json.loads(data.decode('utf-8'))
+    print(event['time'] + ' ' + host + ' ' + event['event'].upper() + ' ' +
+          event['msg'])
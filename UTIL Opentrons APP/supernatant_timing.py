@@ -0,0 +1,89 @@
+# Simulated timing report of the supernatant removal of the Station B
+# protocols.
+#
+# Run it on a computer with the opentrons package installed:
+#     python supernatant_timing.py "<path to the Station B protocol>.py"
+# The protocol is simulated with CONSOLIDATE_TRIPS on and off, and the time
+# saved is printed per run, per sample column and per supernatant trip, from
+# the duration estimate and the gantry travel of each simulation.
+
+import io
+import math
+import os
+import re
+import sys
+
+from opentrons.protocols.duration import DurationEstimator
+from opentrons.simulate import simulate
+
+GANTRY_SPEED = 400  # mm/s
+LABWARE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'LabWare')
+
+
+def point(location):
+    if hasattr(location, 'point'):
+        return location.point
+    return location.top().point
+
+
+def estimate(source, name, consolidate):
+    """
+    Simulates the protocol and returns the duration estimate (s), the gantry
+    travel (mm) between the pipetting locations, the trips to the waste and
+    the sample columns they come from.
+    """
+    protocol = re.sub(r'(?m)^CONSOLIDATE_TRIPS = .*$',
+                      'CONSOLIDATE_TRIPS = ' + str(consolidate), source)
+    estimator = DurationEstimator()
+    runlog, _ = simulate(
+        io.StringIO(protocol), name,
+        custom_labware_paths=[os.path.join(LABWARE_PATH, folder)
+                              for folder in os.listdir(LABWARE_PATH)
+                              if os.path.isdir(os.path.join(LABWARE_PATH,
+                                                            folder))],
+        duration_estimator=estimator)
+    travel = 0
+    last = None
+    trips = 0
+    cols = set()
+    source_col = None
+    for entry in runlog:
+        payload = entry['payload']
+        if not payload.get('location'):
+            continue
+        text = payload['text'].format(**payload)
+        here = point(payload['location'])
+        if last:
+            travel += math.sqrt((here.x - last.x)**2 + (here.y - last.y)**2 +
+                                (here.z - last.z)**2)
+        last = here
+        if text.startswith('Aspirating'):
+            source_col = round(here.x)
+        elif text.startswith('Dispensing') and 'Liquid Waste' in text:
+            trips += 1
+            cols.add(source_col)
+    return estimator.get_total_duration(), travel, trips, len(cols)
+
+
+path = sys.argv[1]
+with open(path, encoding='utf-8') as protocol_file:
+    source = protocol_file.read()
+if not re.search(r'(?m)^CONSOLIDATE_TRIPS = ', source):
+    sys.exit(path + ' has no CONSOLIDATE_TRIPS setting.')
+
+name = os.path.basename(path)
+before, travel_before, trips, num_cols = estimate(source, name, False)
+after, travel_after, _, _ = estimate(source, name, True)
+# the duration estimate only follows the gantry from slot to slot, the
+# travel inside the slots is added at the gantry speed
+saved = before - after + (travel_before - travel_after)/GANTRY_SPEED
+print('Supernatant removal timing of ' + name + ' (' + str(num_cols) +
+      ' sample columns, ' + str(trips) + ' trips to the waste)')
+print('Duration estimate: ' + str(round(before/60, 1)) + ' -> ' +
+      str(round(after/60, 1)) + ' minutes')
+print('Gantry travel: ' + str(round(travel_before/1000, 1)) + ' -> ' +
+      str(round(travel_after/1000, 1)) + ' m')
+print('Saved: ' + str(round(saved)) + ' s per run, ' +
+      str(round(saved/max(num_cols, 1), 1)) + ' s per sample column, ' +
+      str(round(saved/max(trips, 1), 2)) + ' s per trip')
@@ -2,8 +2,9 @@ from opentrons.types import Point
 import json
 import os
 import math
+import socket
 import threading
-from time import sleep
+from time import strftime
 
 metadata = {
     'protocolName': 'Station B RNA Extraction',
@@ -21,6 +22,8 @@ ELUTION_VOL: Volume of final elution that will be transferred to a fresh PCR Pla
 TIP_TRACK: If True, will pick up tips starting after the last accessed up tip from the previous run. If False, will start at the first tip of the first tiprack.
 PARK: If True, will store tips in a designated rack between reagent addition and supernatant removal. If False, will dispose tips after each step.
 FLASH: If True, will flash lights if liquid waste or tip waste needs to be disposed of
+FLASH_PATTERN: Steps of (rail lights on, seconds) repeated while the lights flash.
+ALERT_ADDRESS: (host, port) where pause alerts are sent over UDP (see UTIL Opentrons APP/alert_listener.py), or None.
 """
 
 NUM_SAMPLES = 8
@@ -29,39 +32,84 @@ ELUTION_VOL = 50
 TIP_TRACK = False
 PARK = True
 FLASH = True
+FLASH_PATTERN = [(True, 1), (False, 1)]
+ALERT_ADDRESS = None
 
 
-# Definitions for deck light flashing
-class CancellationToken:
-    def __init__(self):
-       self.is_continued = False
-
-    def set_true(self):
-       self.is_continued = True
-
-    def set_false(self):
-       self.is_continued = False
-
-
-def turn_on_blinking_notification(hardware, pause):
-    while pause.is_continued:
-        hardware.set_lights(rails=True)
-        sleep(1)
-        hardware.set_lights(rails=False)
-        sleep(1)
-
+# Definitions for deck light flashing and operator alerts
+class NotificationService:
+    """
+    `NotificationService` flashes the deck lights and records an alert event
+    while the run is paused for the operator. A single long-lived worker
+    thread waits on a `threading.Event`, so nothing runs between pauses.
+    :param hardware: The robot hardware, or None to not flash the lights.
+    :param pattern (List[tuple]): Flash pattern as (rail lights on, seconds)
+                                  steps, repeated while the alert lasts.
+    :param log_path (str): File the alert events are appended to, or None.
+    :param address (tuple): (host, port) the alert events are sent to over
+                            UDP, or None.
+    """
 
-def create_thread(ctx, cancel_token):
-    t1 = threading.Thread(target=turn_on_blinking_notification, args=(ctx._hw_manager.hardware, cancel_token))
-    t1.start()
-    return t1
+    def __init__(self, hardware, pattern, log_path=None, address=None):
+        self._hardware = hardware
+        self._pattern = pattern
+        self._log_path = log_path
+        self._address = address
+        self._alert = threading.Event()
+        self._quiet = threading.Event()
+        self._quiet.set()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._flash, daemon=True)
+        self._worker.start()
+
+    def _flash(self):
+        while True:
+            self._alert.wait()
+            if self._stopped:
+                return
+            while self._alert.is_set() and not self._stopped:
+                for rails, seconds in self._pattern:
+                    if self._hardware:
+                        self._hardware.set_lights(rails=rails)
+                    if self._quiet.wait(seconds):
+                        break
+            if self._hardware:
+                self._hardware.set_lights(rails=False)
+
+    def _record(self, event, msg):
+        # alerts are best effort, they must never stop the run
+        line = json.dumps({'time': strftime('%Y-%m-%d %H:%M:%S'),
+                           'event': event, 'msg': msg})
+        try:
+            if self._log_path:
+                with open(self._log_path, 'a') as log_file:
+                    log_file.write(line + '\n')
+            if self._address:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.sendto(line.encode('utf-8'), self._address)
+                sock.close()
+        except OSError:
+            pass
+
+    def alert(self, msg):
+        self._record('pause', msg)
+        self._quiet.clear()
+        self._alert.set()
+
+    def clear(self):
+        self._alert.clear()
+        self._quiet.set()
+        self._record('resume', '')
+
+    def stop(self):
+        self._stopped = True
+        self._quiet.set()
+        self._alert.set()
+        self._worker.join()
 
 
 # Start protocol
 def run(ctx):
-    # Setup for flashing lights notification to empty trash
-    cancellationToken = CancellationToken()
-
     """
     Here is where you can change the locations of your labware and modules
     (note that this is the recommended configuration)
@@ -117,6 +165,28 @@ def run(ctx):
 
     folder_path = '/data/B'
     tip_file_path = folder_path + '/tip_log.json'
+    if not ctx.is_simulating() and not os.path.isdir(folder_path):
+        os.mkdir(folder_path)
+
+    # deck lights and alerts while the run is paused for the operator
+    notifier = NotificationService(
+        ctx._hw_manager.hardware if FLASH and not ctx.is_simulating() else None,
+        FLASH_PATTERN,
+        log_path=None if ctx.is_simulating() else folder_path + '/alerts.log',
+        address=None if ctx.is_simulating() else ALERT_ADDRESS)
+
+    def _operator_pause(msg):
+        """
+        `_operator_pause` pauses the run for the operator. The deck lights
+        flash and an alert is recorded until the run is resumed.
+        :param msg (str): Message shown to the operator.
+        """
+        notifier.alert(msg)
+        m300.home()
+        ctx.pause(msg)
+        ctx.home()  # home before continuing with protocol
+        notifier.clear()
+
     tip_log = {'count': {}}
     if TIP_TRACK and not ctx.is_simulating():
         if os.path.isfile(tip_file_path):
@@ -138,8 +208,8 @@ def run(ctx):
     def _pick_up(pip, loc=None):
         nonlocal tip_log
         if tip_log['count'][pip] == tip_log['max'][pip] and not loc:
-            ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-resuming.')
+            _operator_pause('Replace ' + str(pip.max_volume) + 'µl tipracks \
+before resuming.')
             pip.reset_tipracks()
             tip_log['count'][pip] = 0
         if loc:
@@ -162,19 +232,7 @@ resuming.')
         switch = not switch
         drop_count += 8
         if drop_count == drop_threshold:
-            # Setup for flashing lights notification to empty trash
-            if FLASH:
-                if not ctx._hw_manager.hardware.is_simulator:
-                    cancellationToken.set_true()
-                thread = create_thread(ctx, cancellationToken)
-            m300.home()
-            ctx.pause('Please empty tips from waste before resuming.')
-
-            ctx.home()  # home before continuing with protocol
-            if FLASH:
-                cancellationToken.set_false()  # stop light flashing after home
-                thread.join()
-
+            _operator_pause('Please empty tips from waste before resuming.')
             drop_count = 0
 
     waste_vol = 0
@@ -193,19 +251,8 @@ resuming.')
         def _waste_track(vol):
             nonlocal waste_vol
             if waste_vol + vol >= waste_threshold:
-                # Setup for flashing lights notification to empty liquid waste
-                if FLASH:
-                    if not ctx._hw_manager.hardware.is_simulator:
-                        cancellationToken.set_true()
-                    thread = create_thread(ctx, cancellationToken)
-                m300.home()
-                ctx.pause('Please empty liquid waste (slot 11) before resuming.')
-
-                ctx.home()  # home before continuing with protocol
-                if FLASH:
-                    cancellationToken.set_false() # stop light flashing after home
-                    thread.join()
-
+                _operator_pause('Please empty liquid waste (slot 11) before \
+resuming.')
                 waste_vol = 0
             waste_vol += vol
 
@@ -397,6 +444,10 @@ for 2 minutes')
             m300.air_gap(20)
             m300.drop_tip()
 
+    # the steps of the protocol go here, see below
+
+    notifier.stop()  # last, ends the alert worker
+
 """
 Here is where you can call the methods defined above to fit your specific
 protocol. The normal sequence is: